@@ -2,8 +2,25 @@ import re
 import subprocess
 import threading
 
+try:
+    import dbus
+    import dbus.bus
+    import dbus.mainloop.glib
+    import dbus.service
+    from gi.repository import GLib
+except ImportError: # without dbus-python and PyGObject, only the bluetoothctl scanner is available
+    dbus = None
+
 AUDIO_SINK = '0000110b-0000-1000-8000-00805f9b34fb'
 
+_Bluez = 'org.bluez'
+_Adapter = object() # a path standing for the adapter's, which may not be known yet
+_AdapterIface = 'org.bluez.Adapter1'
+_AgentPath = '/player/agent'
+_DeviceIface = 'org.bluez.Device1'
+_ObjectManagerIface = 'org.freedesktop.DBus.ObjectManager'
+_PropertiesIface = 'org.freedesktop.DBus.Properties'
+
 class Device:
     def __init__(self, addr):
         self.addr = addr
@@ -26,6 +43,17 @@ class Device:
         return '{} ({}) class: {}, paired: {}, trusted: {}, connected: {}, rssi: {}'.format(
                 self.addr, self.name, hex(self.cls), self.paired, self.trusted, self.connected, self.rssi)
 
+    def _addRssi(self, rssi): # keep a moving average of the last 10 readings
+        if len(self.rssis) == 10:
+            self._rssisum = self._rssisum - self.rssis[self._rssiidx] + rssi
+            self.rssis[self._rssiidx] = rssi
+            self._rssiidx += 1
+            if self._rssiidx == len(self.rssis): self._rssiidx = 0
+        else:
+            self.rssis.append(rssi)
+            self._rssisum += rssi
+        self.rssi = self._rssisum / len(self.rssis)
+
 class Scanner:
     def __init__(self, onAdded=None, onChanged=None, onRemoved=None):
         self._deesc = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])|[\x01-\x07\n]*')
@@ -128,17 +156,7 @@ class Scanner:
         elif key == 'Paired': dev.paired = value == 'yes'
         elif key == 'Trusted': dev.trusted = value == 'yes'
         elif key == 'Connected': dev.connected = value == 'yes'
-        elif key == 'RSSI':
-            rssi = int(value)
-            if len(dev.rssis) == 10:
-                dev._rssisum = dev._rssisum - dev.rssis[dev._rssiidx] + rssi
-                dev.rssis[dev._rssiidx] = rssi
-                dev._rssiidx += 1
-                if dev._rssiidx == len(dev.rssis): dev._rssiidx = 0
-            else:
-                dev.rssis.append(rssi)
-                dev._rssisum += rssi
-            dev.rssi = dev._rssisum / len(dev.rssis)
+        elif key == 'RSSI': dev._addRssi(int(value))
         elif key == 'UUID':
             m = self._uuidre.search(value)
             if m:
@@ -157,3 +175,159 @@ class Scanner:
         self._checkRunning()
         self._proc.stdin.write(line)
         self._proc.stdin.write("\n")
+
+# the same as Scanner, but talks to BlueZ over D-Bus rather than scraping bluetoothctl's output. devices come from BlueZ's
+# ObjectManager and are kept up to date by PropertiesChanged signals, handled on a GLib main loop running on our thread,
+# which is where the callbacks are called. 'bus' is None for the system bus, or the address of another bus, such as a
+# session bus running a fake BlueZ
+class DBusScanner:
+    def __init__(self, onAdded=None, onChanged=None, onRemoved=None, bus=None):
+        self.bus = bus
+        self.devices = {}
+        self.onAdded = onAdded
+        self.onChanged = onChanged
+        self.onRemoved = onRemoved
+        self._adapter = None # the adapter's object path
+        self._addrs = {} # device object path -> address
+        self._paths = {} # address -> device object path
+        self._scanning = False
+        self._thread = None
+
+    def connect(self, dev): self._call(self._path(dev), _DeviceIface, 'Connect')
+    def disconnect(self, dev): self._call(self._path(dev), _DeviceIface, 'Disconnect')
+    def pair(self, dev): self._call(self._path(dev), _DeviceIface, 'Pair')
+    def remove(self, dev):
+        path = self._path(dev)
+        self.devices.pop(self._addrs.get(path), None)
+        if path is not None: self._call(_Adapter, _AdapterIface, 'RemoveDevice', dbus.ObjectPath(path))
+    def trust(self, dev): self._set(self._path(dev), _DeviceIface, 'Trusted', True)
+    def untrust(self, dev): self._set(self._path(dev), _DeviceIface, 'Trusted', False)
+
+    def start(self, startScan=False):
+        if dbus is None: raise RuntimeError('The D-Bus scanner needs dbus-python and PyGObject.')
+        self.devices = {}
+        (self._adapter, self._addrs, self._paths) = (None, {}, {})
+        dbus.mainloop.glib.threads_init()
+        self._bus = dbus.bus.BusConnection(self.bus if self.bus is not None else dbus.bus.BUS_SYSTEM,
+            mainloop=dbus.mainloop.glib.DBusGMainLoop())
+        self._bus.add_signal_receiver(self._interfacesAdded, 'InterfacesAdded', _ObjectManagerIface, _Bluez)
+        self._bus.add_signal_receiver(self._interfacesRemoved, 'InterfacesRemoved', _ObjectManagerIface, _Bluez)
+        self._bus.add_signal_receiver(self._propertiesChanged, 'PropertiesChanged', _PropertiesIface, _Bluez,
+            path_keyword='path')
+        self._loop = GLib.MainLoop()
+        self._thread = threading.Thread(target=self._main, name='BluetoothScanner', daemon=True)
+        self._thread.start()
+        self._scanning = False
+        if startScan: self.startScan()
+
+    def stop(self):
+        if self._thread:
+            self.stopScan()
+            GLib.idle_add(self._shutdown)
+            self._thread.join(5)
+            self._bus.close()
+            self._thread = self._bus = None
+
+    def startScan(self):
+        if not self._scanning:
+            self._checkRunning()
+            self._scanning = True
+            self._call(_Adapter, _AdapterIface, 'StartDiscovery')
+            self._set(_Adapter, _AdapterIface, 'Discoverable', True)
+
+    def stopScan(self):
+        if self._scanning:
+            self._set(_Adapter, _AdapterIface, 'Discoverable', False)
+            self._call(_Adapter, _AdapterIface, 'StopDiscovery')
+            self._scanning = False
+
+    def _add(self, path, props):
+        addr = str(props.get('Address', ''))
+        if not addr: return
+        (self._addrs[path], self._paths[addr]) = (addr, path)
+        dev = self.devices.get(addr) # we may hear about it from both GetManagedObjects and InterfacesAdded
+        if dev is not None: return self._propertiesChanged(_DeviceIface, props, [], path)
+        self.devices[addr] = dev = Device(addr)
+        self._update(dev, props)
+        if self.onAdded is not None: self.onAdded(self, dev)
+
+    def _call(self, path, iface, method, *args): # calls a method on the loop's thread without waiting for the reply
+        self._checkRunning()
+        if path is None: return # a device we don't know about
+        def call():
+            target = self._adapter if path is _Adapter else path
+            if target is not None:
+                fn = self._bus.get_object(_Bluez, target, introspect=False).get_dbus_method(method, iface)
+                fn(*args, reply_handler=lambda *r: None, error_handler=lambda e: None)
+            return False
+        GLib.idle_add(call)
+
+    def _checkRunning(self):
+        if self._thread is None: raise RuntimeError('The scanner has not been started.')
+
+    def _interfacesAdded(self, path, ifaces):
+        if _AdapterIface in ifaces and self._adapter is None: self._adapter = str(path)
+        if _DeviceIface in ifaces: self._add(str(path), ifaces[_DeviceIface])
+
+    def _interfacesRemoved(self, path, ifaces):
+        if _DeviceIface in ifaces:
+            addr = self._addrs.pop(str(path), None)
+            self._paths.pop(addr, None)
+            dev = self.devices.pop(addr, None)
+            if dev is not None and self.onRemoved is not None: self.onRemoved(self, dev)
+
+    def _main(self):
+        # load the devices BlueZ knows about and register an agent to accept pairing, then handle signals until stopped
+        try: objects = self._bus.get_object(_Bluez, '/', introspect=False).GetManagedObjects(dbus_interface=_ObjectManagerIface)
+        except dbus.DBusException: objects = {} # BlueZ isn't running, but it'll tell us about things if it starts
+        for (path, ifaces) in objects.items(): self._interfacesAdded(path, ifaces)
+        self._agent = _Agent(self._bus, _AgentPath)
+        manager = dbus.Interface(self._bus.get_object(_Bluez, '/org/bluez', introspect=False), 'org.bluez.AgentManager1')
+        try:
+            manager.RegisterAgent(_AgentPath, 'NoInputNoOutput')
+            manager.RequestDefaultAgent(_AgentPath)
+        except dbus.DBusException: pass
+        self._set(_Adapter, _AdapterIface, 'Pairable', True)
+        self._loop.run()
+
+    def _path(self, dev): return self._paths.get(dev.addr if isinstance(dev, Device) else dev)
+
+    def _propertiesChanged(self, iface, changed, invalidated, path=None):
+        dev = self.devices.get(self._addrs.get(str(path))) if iface == _DeviceIface else None
+        if dev is not None:
+            self._update(dev, changed)
+            if self.onChanged is not None: self.onChanged(self, dev)
+
+    def _set(self, path, iface, name, value): self._call(path, _PropertiesIface, 'Set', iface, name, dbus.Boolean(value))
+
+    def _shutdown(self):
+        try:
+            dbus.Interface(self._bus.get_object(_Bluez, '/org/bluez', introspect=False),
+                'org.bluez.AgentManager1').UnregisterAgent(_AgentPath)
+        except dbus.DBusException: pass
+        self._agent.remove_from_connection()
+        self._loop.quit()
+        return False
+
+    def _update(self, dev, props):
+        for (key, value) in props.items():
+            if key == 'Name': dev.name = str(value)
+            elif key == 'Class': dev.cls = int(value)
+            elif key == 'Paired': dev.paired = bool(value)
+            elif key == 'Trusted': dev.trusted = bool(value)
+            elif key == 'Connected': dev.connected = bool(value)
+            elif key == 'RSSI': dev._addRssi(int(value))
+            elif key == 'UUIDs': dev.uuids = [str(u) for u in value]
+
+if dbus is not None:
+    class _Agent(dbus.service.Object): # accepts whatever BlueZ asks, as Scanner answers 'yes' to bluetoothctl's prompts
+        @dbus.service.method('org.bluez.Agent1', in_signature='os', out_signature='')
+        def AuthorizeService(self, device, uuid): pass
+        @dbus.service.method('org.bluez.Agent1', in_signature='', out_signature='')
+        def Cancel(self): pass
+        @dbus.service.method('org.bluez.Agent1', in_signature='', out_signature='')
+        def Release(self): pass
+        @dbus.service.method('org.bluez.Agent1', in_signature='o', out_signature='')
+        def RequestAuthorization(self, device): pass
+        @dbus.service.method('org.bluez.Agent1', in_signature='ou', out_signature='')
+        def RequestConfirmation(self, device, passkey): pass
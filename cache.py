@@ -0,0 +1,103 @@
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+
+_missing = object()
+
+class LRUCache: # a dict holding at most 'size' items, which drops the least recently used item when it's full
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+
+    def __contains__(self, key): return key in self._items
+    def __len__(self): return len(self._items)
+    def __str__(self): return '{}/{} items, {} hits, {} misses'.format(len(self._items), self.size, self.hits, self.misses)
+
+    def clear(self): self._items.clear()
+
+    def get(self, key, default=None):
+        value = self._items.get(key, _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def pop(self, key, default=None): return self._items.pop(key, default)
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.size: self._items.popitem(last=False)
+
+# values worked out from files on a pool of background threads, saved in a JSON file keyed by path and validated by each
+# file's modification time and size, so each file only has to be read once. the file is loaded by the first piece of
+# work and written whenever the work runs out, dropping entries whose paths keep(path) rejects
+class FileCache:
+    def __init__(self, cacheFile, keep, version, name, workers=1):
+        self.cacheFile = cacheFile
+        self.keep = keep
+        self.version = version
+        self.name = name
+        self.workers = workers
+        self.quitting = False
+        self._entries = None # path -> [mtime, size] + value, where a value is a list
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._pool = None
+
+    def get(self, path, stat): # returns the value cached for a file, given its os.stat(), or None
+        entry = self._entries.get(path)
+        return entry[2:] if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size else None
+
+    def peek(self, path): # returns the value cached for a file without checking that it's current, or None
+        entry = self._entries.get(path) if self._entries is not None else None
+        return entry[2:] if entry is not None else None
+
+    def put(self, path, stat, value):
+        with self._lock:
+            self._entries[path] = [stat.st_mtime_ns, stat.st_size] + value
+            self._dirty = True
+
+    def stop(self):
+        if self._pool is not None:
+            self.quitting = True
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def submit(self, fn, *args): # runs fn(*args) on a worker thread once the cache is loaded
+        if self._pool is None: self._pool = concurrent.futures.ThreadPoolExecutor(self.workers, self.name)
+        with self._lock: self._outstanding += 1
+        self._pool.submit(self._run, fn, args)
+
+    def _load(self):
+        try:
+            with open(self.cacheFile) as f: cache = json.load(f)
+            if cache.get('version') == self.version: return cache['songs']
+        except (OSError, ValueError, KeyError): pass
+        return {}
+
+    def _run(self, fn, args):
+        try:
+            with self._lock:
+                if self._entries is None: self._entries = self._load()
+            if not self.quitting: fn(*args)
+        finally:
+            with self._lock:
+                self._outstanding -= 1
+                if self._outstanding == 0 and self._dirty: self._save()
+
+    def _save(self):
+        self._entries = {p: e for p, e in self._entries.items() if self.keep(p)} # forget files that are gone
+        try:
+            with open(self.cacheFile + '.tmp', 'w') as f:
+                json.dump({'version': self.version, 'songs': self._entries}, f, separators=(',',':'))
+            os.replace(self.cacheFile + '.tmp', self.cacheFile)
+            self._dirty = False
+        except OSError: pass
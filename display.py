@@ -1,9 +1,19 @@
 import board
+import cache
 import digitalio
-from PIL import Image, ImageDraw, ImageFont
+import threading
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 from RPi import GPIO
 from adafruit_rgb_display import st7789
 
+try:
+    import numpy
+except ImportError: # without numpy we diff frames with PIL and let the driver convert them
+    numpy = None
+
+_Band = 16 # rows per band when looking for the parts of a frame that changed
+_Margin = 4 # room around rendered text for glyphs that stick out of their boxes
+
 class Display:
     A = 5
     B = 6
@@ -21,16 +31,28 @@ class Display:
     Orange = (255,128,0)
     Yellow = (255,255,0)
 
-    def __init__(self, onpress=None):
+    def __init__(self, onpress=None, fullRefresh=False):
         self.display = st7789.ST7789(
             board.SPI(), height=240, y_offset=80, rotation=180, baudrate=24000000,
             cs=digitalio.DigitalInOut(board.CE0), dc=digitalio.DigitalInOut(board.D25), rst=digitalio.DigitalInOut(board.D24))
         self.width = self.display.width
         self.height = self.display.height
-        self.frame = Image.new("RGB", (self.width, self.height))
-        self.draw = ImageDraw.Draw(self.frame)
         self.font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 20)
-        self.draw.font = self.font
+        self.fullRefresh = fullRefresh # if true, send the whole frame every time rather than just the parts that changed
+        self.sent = [0, 0, 0] # frames and pixels sent to the panel, and frames dropped because newer ones replaced them
+        # frames are drawn on the caller's thread and sent on ours. we need one buffer to draw into, one waiting to be sent
+        # and one being sent, so three (image, draw) buffers are enough
+        self._free = [self._newBuffer() for _ in range(3)]
+        (self.frame, self.draw) = self._free.pop()
+        self._last = None # what the panel is showing
+        if numpy is not None: # RGB565 buffers reused for every frame. _shown is in the panel's orientation
+            (self._rgb, self._tmp) = (numpy.zeros((self.height, self.width), numpy.uint16) for _ in range(2))
+            (self._shown, self._diff) = (None, None)
+        (self._pending, self._quit, self._cond) = (None, False, threading.Condition())
+        self._thread = threading.Thread(target=self._render, name='Display', daemon=True)
+        self._thread.start()
+        self.sizes = cache.LRUCache(2048) # (text, font) -> (width, height), since FreeType layout is slow on a Pi
+        self.masks = cache.LRUCache(256) # (text, font) -> (mask, x, y) of rendered text, so repainting a list is just pastes
         GPIO.setmode(GPIO.BCM)
         for b in [Display.A, Display.B, Display.U, Display.D, Display.L, Display.R, Display.C]:
             GPIO.setup(b, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -41,22 +63,147 @@ class Display:
 
     def center(self, text, fill=None, y=None, font=None):
         if font is None: font = self.font
-        (w,h) = self.draw.textsize(text, font)
+        (w,h) = self.textsize(text, font)
         if y is None: y = (self.height-h) // 2
         x = (self.width-w) // 2
         if x < 0: x = 0
-        self.draw.text((x,y), text, fill, font)
+        self.text(x, y, text, fill, font)
         return (y,h)
         
     def cleanup(self):
         self.clear()
         self.flip()
+        with self._cond: # let the render thread send what's left and exit
+            self._quit = True
+            self._cond.notify()
+        self._thread.join()
         self.power(False)
         GPIO.cleanup()
 
     def clear(self, color = (0,0,0)): self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=color)
-    def flip(self): self.display.image(self.frame)
+    def flip(self, full=False): # queue the frame to be sent and start a new one. a frame that hasn't been sent yet is dropped
+        with self._cond:
+            if self._pending is not None:
+                self._free.append(self._pending[0])
+                full = full or self._pending[1]
+                self.sent[2] += 1
+            self._pending = ((self.frame, self.draw), full)
+            (self.frame, self.draw) = self._free.pop() # the caller will clear it before drawing
+            self._cond.notify()
     def power(self, on): GPIO.output(Display.BACKLIGHT, GPIO.HIGH if on else GPIO.LOW)
     def rect(self, x, y, width, height, color): self.draw.rectangle((x, y, x+width, y+height), outline=0, fill=color)
-    def text(self, x, y, text, fill=None, font=None): self.draw.text((x,y), text, fill, font)
-    def textsize(self, text, font=None): return self.draw.textsize(text, self.font if font is None else font)
+    def text(self, x, y, text, fill=None, font=None):
+        if font is None: font = self.font
+        if fill is None: return self.draw.text((x,y), text, fill, font)
+        mask = self.masks.get((text, font))
+        if mask is None:
+            (w,h) = self.textsize(text, font)
+            image = Image.new('L', (w + _Margin*2, h + _Margin*2))
+            ImageDraw.Draw(image).text((_Margin, _Margin), text, 255, font)
+            box = image.getbbox()
+            mask = (image.crop(box), box[0] - _Margin, box[1] - _Margin) if box else (None, 0, 0)
+            self.masks.put((text, font), mask)
+        if mask[0]: self.frame.paste(fill, (x + mask[1], y + mask[2]), mask[0]) # the colour is applied by the paste
+    def _damage(self, frame): # returns boxes covering the pixels that differ from the last frame sent, merging adjacent bands
+        diff = ImageChops.difference(frame, self._last)
+        bbox = diff.getbbox()
+        if bbox is None: return []
+        boxes = []
+        for y in range(bbox[1] - bbox[1] % _Band, bbox[3], _Band):
+            band = diff.crop((0, y, self.width, min(y+_Band, self.height))).getbbox()
+            if band is None: continue
+            box = (band[0], y + band[1], band[2], y + band[3])
+            if boxes and boxes[-1][3] == box[1]: # contiguous with the last one
+                last = boxes[-1]
+                box = (min(last[0], box[0]), last[1], max(last[2], box[2]), box[3])
+                boxes[-1] = box
+            else: boxes.append(box)
+        return boxes
+
+    def _newBuffer(self):
+        frame = Image.new("RGB", (self.width, self.height))
+        draw = ImageDraw.Draw(frame)
+        draw.font = self.font
+        return (frame, draw)
+
+    def _render(self): # the render thread, which sends the latest frame whenever there is one
+        while True:
+            with self._cond:
+                while self._pending is None and not self._quit: self._cond.wait()
+                if self._pending is None: return
+                ((buffer, full), self._pending) = (self._pending, None)
+            self._show(buffer[0], full)
+            with self._cond: self._free.append(buffer)
+
+    def _send(self, frame, box): # send part of a frame to the panel, which is upside down if rotation is 180
+        image = frame.crop(box) if box != (0, 0, self.width, self.height) else frame
+        if self.display.rotation == 180: (x, y) = (self.width - box[2], self.height - box[3])
+        else: (x, y) = box[0:2]
+        self.display.image(image, x=x, y=y)
+        self.sent[1] += image.width * image.height
+
+    def _show(self, frame, full):
+        if numpy is not None: self._show565(frame, full)
+        elif full or self.fullRefresh or self._last is None or self.display.rotation not in (0, 180):
+            self._send(frame, (0, 0, self.width, self.height))
+            self._last = frame.copy()
+        else:
+            for box in self._damage(frame): # send only the windows that changed, since SPI is slow
+                self._send(frame, box)
+                self._last.paste(frame.crop(box), box)
+        self.sent[0] += 1
+
+    def _show565(self, frame, full): # convert to RGB565 and send the windows of rows that changed straight to the panel
+        panel = numpy.rot90(_toRGB565(frame, self._rgb, self._tmp), self.display.rotation // 90) # a view, not a copy
+        if self._shown is None or self._shown.shape != panel.shape:
+            (self._shown, self._diff, full) = (numpy.zeros(panel.shape, '>u2'), numpy.zeros(panel.shape, bool), True)
+        if full or self.fullRefresh: self._diff.fill(True)
+        else: numpy.not_equal(panel, self._shown, out=self._diff)
+        rows = numpy.flatnonzero(self._diff.any(axis=1))
+        if not len(rows): return
+        breaks = numpy.flatnonzero(numpy.diff(rows) > 1) # split the rows into runs of adjacent ones
+        for (y0, y1) in zip([rows[0]] + list(rows[breaks+1]), list(rows[breaks]) + [rows[-1]]):
+            cols = numpy.flatnonzero(self._diff[y0:y1+1].any(axis=0))
+            (x0, x1) = (int(cols[0]), int(cols[-1]))
+            window = self._shown[y0:y1+1, x0:x1+1]
+            window[...] = panel[y0:y1+1, x0:x1+1] # big-endian, as the panel wants it
+            self.display._block(x0, int(y0), x1, int(y1), window.tobytes())
+            self.sent[1] += window.size
+
+    def textsize(self, text, font=None):
+        if font is None: font = self.font
+        size = self.sizes.get((text, font))
+        if size is None:
+            size = self.draw.textsize(text, font)
+            self.sizes.put((text, font), size)
+        return size
+
+def _toRGB565(frame, out, tmp): # convert an RGB image into 'out' as 5-6-5 bit colour, using 'tmp' as scratch space
+    rgb = numpy.asarray(frame)
+    numpy.bitwise_and(rgb[...,0], 0xF8, out=out)
+    numpy.left_shift(out, 8, out=out)
+    numpy.bitwise_and(rgb[...,1], 0xFC, out=tmp)
+    numpy.left_shift(tmp, 3, out=tmp)
+    numpy.bitwise_or(out, tmp, out=out)
+    numpy.right_shift(rgb[...,2], 3, out=tmp)
+    numpy.bitwise_or(out, tmp, out=out)
+    return out
+
+# python3 display.py [FRAMES] times converting a frame to RGB565 the way the driver does (fresh arrays each time) and with
+# our reused buffers
+if __name__ == '__main__':
+    import sys, time
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    frame = Image.new('RGB', (240, 240))
+    draw = ImageDraw.Draw(frame)
+    for y in range(240): draw.line((0, y, 239, y), (y, 255-y, (y*7) % 256))
+    draw.text((10, 100), 'Some Artist - Some Title', (255, 255, 255))
+    def fresh():
+        rgb = numpy.asarray(frame).astype(numpy.uint16)
+        return (((rgb[...,0] & 0xF8) << 8) | ((rgb[...,1] & 0xFC) << 3) | (rgb[...,2] >> 3)).astype('>u2').tobytes()
+    (out, tmp) = (numpy.zeros((240, 240), numpy.uint16), numpy.zeros((240, 240), numpy.uint16))
+    assert fresh() == _toRGB565(frame, out, tmp).astype('>u2').tobytes()
+    for (name, fn) in (('fresh arrays', fresh), ('reused buffers', lambda: _toRGB565(frame, out, tmp))):
+        start = time.perf_counter()
+        for _ in range(count): fn()
+        print('{}: {:.3f} ms/frame'.format(name, (time.perf_counter() - start) * 1000 / count))
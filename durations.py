@@ -0,0 +1,47 @@
+import cache
+import os
+import threading
+import vlc
+
+_cacheVersion = 1
+_parseTimeout = 5000 # milliseconds
+
+# knows how long songs are, so painting never has to wait for vlc to open a file. durations are cached in a
+# cache.FileCache. get() answers from it, and the first time it's asked about each song it queues the song to be
+# checked, and parsed by vlc if the cache doesn't have it. onDuration(song) is called on a worker thread when a song's
+# duration becomes known
+class Durations:
+    def __init__(self, library, newMedia, cacheFile, onDuration):
+        self.library = library
+        self.newMedia = newMedia # song -> vlc.Media
+        self.onDuration = onDuration
+        self._cache = cache.FileCache(cacheFile, library.keepCached, _cacheVersion, 'Durations')
+        self._checked = set() # songs we've queued this session
+
+    def get(self, song): # returns the song's duration in milliseconds, or None if it's not known yet
+        if song not in self._checked:
+            self._checked.add(song)
+            self._cache.submit(self._check, song)
+        value = self._cache.peek(song.path)
+        return value[0] if value else None
+
+    def stop(self): self._cache.stop()
+
+    def _check(self, song):
+        try: s = os.stat(self.library.getPath(song))
+        except OSError: return
+        if self._cache.get(song.path, s) is None:
+            ms = self._parse(song)
+            if ms is None: return
+            self._cache.put(song.path, s, [ms])
+        self.onDuration(song)
+
+    def _parse(self, song): # returns the duration in milliseconds, or None if vlc couldn't tell
+        media = self.newMedia(song)
+        parsed = threading.Event()
+        media.event_manager().event_attach(vlc.EventType.MediaParsedChanged, lambda e: parsed.set())
+        if media.parse_with_options(vlc.MediaParseFlag.local, _parseTimeout) != 0: return None
+        parsed.wait(_parseTimeout/1000 + 1)
+        if media.get_parsed_status() != vlc.MediaParsedStatus.done: return None
+        ms = media.get_duration()
+        return ms if ms > 0 else None
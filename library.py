@@ -1,159 +1,684 @@
+import concurrent.futures
+import itertools
+import json
 import os
 import random
 import re
-import stat
+import sys
 
 _numRe = re.compile(r'^\s*[0-9]+\s*$')
 _songRe = re.compile(r"^\s*(.+?)\s+-\s+(.+?)\.[^\.]+$", re.S)
+_indexVersion = 2
+_journalLimit = 1000 # journal entries before we rewrite the playlist file
+_playedLimit = 4000 # ranges of played songs we'll save. with more, a restart just begins a new pass
+_viewKeys = {'artists': lambda s: s.artist, 'folders': lambda s: os.path.basename(os.path.dirname(s.path))}
 _exts = {e:None for e in ['aac','aiff','alac','au','flac','m4a','m4b','mp3','oga','ogg','opus','ra','rm','wav','webm','wma']}
 
+class Change: # describes how Library.update() changed the library
+    def __init__(self):
+        self.groups = [] # groups that were added or whose songs changed
+        self.added = []
+        self.removed = [] # including songs that were renamed
+        self.renamed = [] # (old, new) song pairs
+        self.retagged = [] # songs whose artist or title changed
+        self.playlistChanged = False
+
 class Group:
+    __slots__ = ('name', 'songs')
     def __init__(self, name, songs):
         self.name = name
         self.songs = songs
     def __str__(self): return self.name
 
-class Song:
-    def __init__(self, path, artist, title):
+class Song: # there can be tens of thousands of these, so keep them small and share the artist names, which repeat a lot
+    __slots__ = ('path', 'artist', 'title', 'id')
+    def __init__(self, path, artist, title, id=None):
         self.path = path
-        self.artist = artist
+        self.artist = sys.intern(artist)
         self.title = title
+        self.id = id # stable across restarts, as long as the library index is kept
     def __str__(self): return self.artist + ' - ' + self.title
 
+    def retag(self, artist, title): # returns True if the artist or title changed
+        changed = False
+        if artist and artist != self.artist: (self.artist, changed) = (sys.intern(artist), True)
+        if title and title != self.title: (self.title, changed) = (title, True)
+        return changed
+
 class Library:
-    def __init__(self, root):
+    def __init__(self, root, indexFile=None, workers=1):
         self.root = root
-        self.groups = None
+        self.indexFile = indexFile
+        self.workers = workers
+        self.groups = {}
+        self.scanning = False # while true, only the groups published so far can be found
+        self.version = 0 # incremented whenever the songs change
+        # rel -> (mtime, entries), where an entry is (name,) for a directory or (name, artist, title, id) for a song, with
+        # a fifth item, 1, once the artist and title have been read from the song's tags
+        self._dirs = None
+        self._byId = {}
+        self._byPath = {}
+        self._ids = itertools.count(1)
+        (self._views, self._viewVersion) = ({}, None)
 
     def __str__(self): return self.root
 
+    def addGroup(self, group): # publish a group that scan() passed to onGroup, while the rest are still loading
+        self.groups[group.name] = group
+        self.version += 1
+
+    def all(self): # returns a Group of every song, rebuilt only when the library changes
+        self._checkViews()
+        group = self._views.get('all')
+        if group is None: self._views['all'] = group = Group('All', [s for g in self.groups.values() for s in g.songs])
+        return group
+
+    def sortedGroups(self):
+        self._checkViews()
+        groups = self._views.get('sorted')
+        if groups is None: self._views['sorted'] = groups = sorted(self.groups.values(), key=lambda g: g.name)
+        return groups
+
+    def view(self, kind, songs): # returns a dict of 'artists' or 'folders' -> songs, in the order they first appear
+        self._checkViews()
+        key = (kind, id(songs))
+        v = self._views.get(key)
+        if v is None or v[0] is not songs:
+            d = {}
+            keyfn = _viewKeys[kind]
+            for s in songs:
+                L = d.get(keyfn(s))
+                if L is None: d[keyfn(s)] = L = []
+                L.append(s)
+            v = (songs, d)
+            if self._owns(songs): self._views[key] = v # other lists (like the playlist) can change without the version changing
+        return v[1]
+
+    def dirs(self): return list(self._dirs) if self._dirs else []
+    def findSong(self, path): return self._byPath.get(path)
     def getPath(self, song): return os.path.join(self.root, song.path)
+    def getSong(self, id): return self._byId.get(id)
+    def keepCached(self, path): return self.scanning or path in self._byPath # whether to keep a cache entry for a song
 
-    def scan(self):
-        self.groups = {}
-        for name in os.listdir(self.root):
-            s = os.stat(os.path.join(self.root, name))
-            if stat.S_ISDIR(s.st_mode):
-                self.groups[name] = self._scanGroup(name)
+    def readDir(self, rel): # returns (mtime, entries) for a directory relative to the root, or None if it doesn't exist
+        dir = os.path.join(self.root, rel)
+        try:
+            mtime = os.stat(dir).st_mtime_ns
+            entries = Library._readDir(dir, rel)
+        except (FileNotFoundError, NotADirectoryError): return None
+        if not rel: entries = [e for e in entries if len(e) == 1] # only directories (groups) matter at the top level
+        return (mtime, entries)
 
-    def _scanGroup(self, name):
-        return Group(name, Library._scanSongs(self.root, name, []))
+    def saveIndex(self): self._saveIndex()
 
-    @staticmethod
-    def _scanSongs(root, rel, songs):
-        dir = os.path.join(root, rel)
-        for name in os.listdir(dir):
-            s = os.stat(os.path.join(dir, name))
-            if stat.S_ISDIR(s.st_mode):
-                Library._scanSongs(root, rel+'/'+name, songs)
+    def scan(self, workers=None, onGroup=None, onProgress=None, first=None):
+        if workers is None: workers = self.workers
+        self.scanning = True
+        try: self._scan(workers, onGroup, onProgress, first)
+        finally: self.scanning = False
+
+    def update(self, changes, renames={}): # apply changed directories from a Watcher, returning a Change or None
+        (groups, dropped) = ({}, set())
+        def drop(rel):
+            prefix = rel + '/'
+            for r in [r for r in self._dirs if r == rel or r.startswith(prefix)]: del self._dirs[r]
+            dropped.add(rel.split('/', 1)[0])
+        for rel, d in changes.items():
+            if rel == '':
+                if d is not None:
+                    for name in [name for name in self.groups if (name,) not in d[1]]: drop(name)
+                continue
+            old = self._dirs.get(rel)
+            if d is None: drop(rel)
             else:
-                (base, ext) = os.path.splitext(name)
-                if ext[1:].lower() in _exts:
-                    m = _songRe.fullmatch(name)
-                    if not m:
-                        (artist, title) = ('Unknown', base)
-                    else:
-                        (artist, title) = m.groups()
-                        if _numRe.search(artist): # if 'artist' is a number, get it from the directory
-                            slash = rel.find('/') # strip the group name off the front
-                            if slash >= 0: (artist, title) = (os.path.basename(rel[slash+1:]), artist + ' - ' + title)
-                            else: artist = 'Unknown'
-                    songs.append(Song(rel+'/'+name, artist, title))
+                if old is not None:
+                    for e in old[1]:
+                        if len(e) == 1 and e not in d[1]: drop(rel + '/' + e[0])
+                self._dirs[rel] = d = (d[0], self._assignIds(d[1], old))
+                groups[rel.split('/', 1)[0]] = None
+        change = Change()
+        (added, removed) = ({}, {})
+        for name in dropped:
+            if name not in groups and name not in self._dirs and name in self.groups:
+                for s in self.groups.pop(name).songs: removed[s.path] = s
+        for name in groups:
+            if name not in self._dirs: continue # a subdirectory of a group that was removed
+            group = self.groups.get(name)
+            if group is None: self.groups[name] = group = Group(name, [])
+            old = {s.path: s for s in group.songs}
+            group.songs[:] = self._collect(name, [], self._byPath) # update in place since menus may have a reference to it
+            for s in group.songs:
+                if old.get(s.path) is s: del old[s.path]
+                else: added[s.path] = s
+            removed.update(old)
+            change.groups.append(group)
+        for s in removed.values():
+            if self._byPath.get(s.path) is s: del self._byPath[s.path]
+            if self._byId.get(s.id) is s: del self._byId[s.id]
+        if not added and not removed: return None
+        for old in removed.values():
+            path = renames.get(old.path)
+            if path is None: # see if a directory containing it was renamed
+                for (a, b) in renames.items():
+                    if old.path.startswith(a + '/'):
+                        path = b + old.path[len(a):]
+                        break
+            new = added.get(path)
+            if new is not None: change.renamed.append((old, new))
+        (change.added, change.removed) = (list(added.values()), list(removed.values()))
+        self.version += 1
+        return change
+
+    def applyTags(self, tags): # apply [(song, artist, title)] read from the songs' tags, returning a Change or None
+        change = Change()
+        (groups, dirs) = ({}, {})
+        for (song, artist, title) in tags:
+            if self._byId.get(song.id) is not song: continue
+            if song.retag(artist, title):
+                change.retagged.append(song)
+                group = self.groups.get(song.path.split('/', 1)[0])
+                if group is not None: groups[group.name] = group
+            (rel, name) = song.path.rsplit('/', 1)
+            dirs.setdefault(rel, {})[name] = song
+        for rel, songs in dirs.items(): # remember the names in the index so we needn't read the tags again
+            entries = self._dirs[rel][1] if rel in self._dirs else ()
+            for i, e in enumerate(entries):
+                song = songs.get(e[0]) if len(e) != 1 else None
+                if song is not None and song.id == e[3]: entries[i] = (e[0], song.artist, song.title, e[3], 1)
+        if not change.retagged: return None
+        change.groups = list(groups.values())
+        self.version += 1
+        return change
+
+    def untagged(self, groups=None): # returns the songs whose tags haven't been read, in the named groups or all of them
+        songs = []
+        for rel, d in self._dirs.items():
+            if groups is not None and rel.split('/', 1)[0] not in groups: continue
+            for e in d[1]:
+                song = self._byPath.get(rel + '/' + e[0]) if len(e) == 4 else None
+                if song is not None: songs.append(song)
+        return songs
+
+    def _checkViews(self):
+        if self._viewVersion != self.version: (self._views, self._viewVersion) = ({}, self.version)
+
+    def _owns(self, songs):
+        all = self._views.get('all')
+        return all is not None and songs is all.songs or any(g.songs is songs for g in self.groups.values())
+
+    def _loadIndex(self):
+        if self.indexFile:
+            try:
+                with open(self.indexFile) as f: index = json.load(f)
+                if index.get('version') == _indexVersion and index.get('root') == self.root:
+                    self._ids = itertools.count(index['nextId'])
+                    return {rel: (d[0], [(e[0],) if len(e) == 1 else (e[0], sys.intern(e[1]), e[2], e[3]) + tuple(e[4:]) for e in d[1]])
+                            for rel, d in index['dirs'].items()}
+            except (OSError, ValueError, KeyError, IndexError, TypeError): pass
+        return {}
+
+    def _saveIndex(self):
+        if self.indexFile:
+            try:
+                with open(self.indexFile + '.tmp', 'w') as f:
+                    index = {'version': _indexVersion, 'root': self.root, 'nextId': next(self._ids), 'dirs': self._dirs}
+                    json.dump(index, f, separators=(',',':'))
+                os.replace(self.indexFile + '.tmp', self.indexFile) # so a power cut can't leave a truncated index
+            except OSError: pass
+
+    def _assignIds(self, entries, old): # give new songs new IDs while songs that were already there keep theirs
+        ids = {e[0]: e[3] for e in old[1] if len(e) != 1} if old else {}
+        return [e if len(e) == 1 else e + (ids.get(e[0]) or next(self._ids),) for e in entries]
+
+    def _collect(self, rel, songs, reuse): # gather songs in directory order, exactly as a serial recursive walk would
+        d = self._dirs.get(rel)
+        if d is not None:
+            for e in d[1]:
+                if len(e) == 1: self._collect(rel+'/'+e[0], songs, reuse)
+                else:
+                    path = rel+'/'+e[0]
+                    song = reuse.get(path)
+                    if song is None or song.id != e[3]: song = Song(path, e[1], e[2], e[3])
+                    self._byPath[path] = self._byId[song.id] = song
+                    songs.append(song)
         return songs
 
+    def _scan(self, workers, onGroup, onProgress, first):
+        old = self._dirs if self._dirs is not None else self._loadIndex()
+        (self._dirs, self._changed, self._counts) = ({}, False, [0, 0])
+        (reuse, self._byPath, self._byId) = (self._byPath, {}, {})
+        with os.scandir(self.root) as it: names = [e.name for e in it if e.is_dir()]
+        groups = {}
+        def publish(name):
+            groups[name] = group = Group(name, self._collect(name, [], reuse))
+            if onGroup: onGroup(group)
+        order = sorted(names, key=lambda name: name != first) # scan the 'first' group before the others
+        if workers > 1: self._walkParallel(order, old, workers, publish, onProgress)
+        else:
+            for name in order:
+                self._walk(name, old, onProgress)
+                publish(name)
+        self.groups = {name: groups[name] for name in names}
+        self.version += 1
+        if self._changed or len(self._dirs) != len(old): self._saveIndex()
+
+    def _scanDir(self, rel, old):
+        dir = os.path.join(self.root, rel)
+        mtime = os.stat(dir).st_mtime_ns
+        d = old.get(rel)
+        if d is None or d[0] != mtime: # the directory has changed (or is new) since the index was written, so re-read it
+            d = (mtime, self._assignIds(Library._readDir(dir, rel), d))
+            self._changed = True
+        return d
+
+    def _progress(self, d, onProgress):
+        self._counts[0] += 1
+        self._counts[1] += sum(1 for e in d[1] if len(e) != 1)
+        if onProgress: onProgress(*self._counts)
+
+    def _walk(self, rel, old, onProgress):
+        self._dirs[rel] = d = self._scanDir(rel, old)
+        self._progress(d, onProgress)
+        for e in d[1]:
+            if len(e) == 1: self._walk(rel+'/'+e[0], old, onProgress)
+
+    def _walkParallel(self, names, old, workers, publish, onProgress):
+        with concurrent.futures.ThreadPoolExecutor(workers, 'LibraryScanner') as pool:
+            (pending, remaining) = ({}, {name: 0 for name in names}) # remaining counts each group's unscanned directories
+            def submit(rel, group):
+                pending[pool.submit(self._scanDir, rel, old)] = (rel, group)
+                remaining[group] += 1
+            for name in names: submit(name, name)
+            while pending:
+                (done, _) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    (rel, group) = pending.pop(f)
+                    self._dirs[rel] = d = f.result()
+                    self._progress(d, onProgress)
+                    for e in d[1]:
+                        if len(e) == 1: submit(rel+'/'+e[0], group)
+                    remaining[group] -= 1
+                    if not remaining[group]: publish(group)
+
+    @staticmethod
+    def _readDir(dir, rel):
+        entries = []
+        with os.scandir(dir) as it:
+            for e in it:
+                if e.is_dir(): entries.append((e.name,))
+                else:
+                    (base, ext) = os.path.splitext(e.name)
+                    if ext[1:].lower() in _exts:
+                        m = _songRe.fullmatch(e.name)
+                        if not m:
+                            (artist, title) = ('Unknown', base)
+                        else:
+                            (artist, title) = m.groups()
+                            if _numRe.search(artist): # if 'artist' is a number, get it from the directory
+                                slash = rel.find('/') # strip the group name off the front
+                                if slash >= 0: (artist, title) = (os.path.basename(rel[slash+1:]), artist + ' - ' + title)
+                                else: artist = 'Unknown'
+                        entries.append((e.name, sys.intern(artist), title))
+        return entries
+
+class SongList: # the songs in a playlist, with O(log n) lookup of a song's position and removal
+    def __init__(self, key=lambda s: s.id):
+        self._key = key
+        self.clear()
+
+    def __contains__(self, song): return self._key(song) in self._slots
+    def __iter__(self): return (s for s in self._items if s is not None)
+    def __len__(self): return self._count
+
+    def __getitem__(self, index):
+        if index < 0: index += self._count
+        if index < 0 or index >= self._count: raise IndexError('song index out of range')
+        return self._items[self._find(index)]
+
+    def atSlot(self, slot): return self._items[slot] # returns None if the song in that slot was removed
+    def get(self, key):
+        slot = self._slots.get(key)
+        return self._items[slot] if slot is not None else None
+    def slotCount(self): return len(self._items)
+
+    def append(self, song):
+        self._slots[self._key(song)] = len(self._items)
+        self._items.append(song)
+        self._count += 1
+        i = len(self._items)
+        self._tree.append(1 + self._sum(i-1) - self._sum(i - (i & -i)))
+
+    def clear(self):
+        self._items = [] # songs by slot, with None for removed songs
+        self._slots = {} # key -> slot
+        self._tree = [0] # a Fenwick tree counting the songs in each range of slots (1-based)
+        self._count = 0
+        self.generation = getattr(self, 'generation', 0) + 1 # incremented whenever the slots are renumbered
+
+    def extend(self, songs):
+        for song in songs: self.append(song)
+
+    def position(self, song): # returns the position of the song, or None if it's not in the list
+        slot = self._slots.get(self._key(song))
+        return self._sum(slot) if slot is not None else None
+
+    def remove(self, song): # returns the position the song had, or None if it wasn't in the list
+        slot = self._slots.pop(self._key(song), None)
+        if slot is None: return None
+        position = self._sum(slot)
+        self._items[slot] = None
+        self._count -= 1
+        i = slot + 1
+        while i < len(self._tree):
+            self._tree[i] -= 1
+            i += i & -i
+        if len(self._items) > 64 and self._count < len(self._items) // 2: self.reset(list(self)) # compact the slots
+        return position
+
+    def replace(self, old, new):
+        slot = self._slots.pop(self._key(old))
+        self._slots[self._key(new)] = slot
+        self._items[slot] = new
+
+    def reset(self, songs): # replaces the contents in O(n), keeping this object since others may have a reference to it
+        self._items = list(songs)
+        self._slots = {self._key(self._items[i]): i for i in range(len(self._items))}
+        self.generation += 1
+        self._count = n = len(self._items)
+        self._tree = tree = [0] + [1]*n
+        for i in range(1, n+1):
+            j = i + (i & -i)
+            if j <= n: tree[j] += tree[i]
+
+    def _find(self, index): # returns the slot of the song at the given position
+        (slot, bit) = (0, 1 << (len(self._tree)-1).bit_length())
+        while bit:
+            if slot + bit < len(self._tree) and self._tree[slot + bit] <= index:
+                slot += bit
+                index -= self._tree[slot]
+            bit >>= 1
+        return slot
+
+    def _sum(self, i): # returns the number of songs in the first i slots
+        n = 0
+        while i:
+            n += self._tree[i]
+            i -= i & -i
+        return n
+
+class Shuffle: # a random order to play a SongList in, drawn lazily so turning it on is O(1) whatever the list's size
+    def __init__(self, songs, seed=None):
+        self.songs = songs
+        self.history = [] # songs in the order they were (or will next be) played
+        self.cursor = -1 # the index within history of the current song
+        self._newPass(seed)
+
+    def current(self): return self.history[self.cursor] if self.cursor >= 0 else None
+    def state(self): # the songs drawn in this pass and the recent history, for restore(). IDs are stored as ranges
+        start = max(0, self.cursor - 49)
+        state = {'history': [s.id for s in self.history[start:]], 'cursor': self.cursor - start}
+        played = _toRanges(sorted(self._played))
+        if len(played) <= _playedLimit: state['played'] = played
+        return state
+
+    def next(self, wrap=False, advance=True): # returns the next song, or None if every song has been played
+        i = self.cursor + 1
+        while i < len(self.history) and self.history[i] not in self.songs: del self.history[i] # skip removed songs
+        if i == len(self.history):
+            song = self._draw()
+            if song is None:
+                if not wrap or not len(self.songs): return None
+                self._newPass()
+                song = self._draw()
+            self.history.append(song)
+        if advance: self.cursor = i
+        return self.history[i]
+
+    def previous(self, advance=True): # returns the previous song, or None if there isn't one
+        i = self._previousIndex()
+        if i < 0: return None
+        if advance: self.cursor = i
+        return self.history[i]
+
+    def restore(self, state): # continues the pass that state() was taken from. the rest of it is drawn in a new order
+        self._played.update(i for (start, count) in state.get('played', ()) for i in range(start, start+count))
+        history = [self.songs.get(id) for id in state['history']]
+        self.cursor = sum(1 for s in history[:state['cursor']+1] if s is not None) - 1
+        self.history = [s for s in history if s is not None]
+
+    def setCurrent(self, song):
+        for i in (self.cursor, self.cursor + 1, self._previousIndex()): # usually it's one we just peeked at
+            if 0 <= i < len(self.history) and self.history[i] is song:
+                self.cursor = i
+                return
+        self.cursor += 1 # otherwise, play it next in the order, keeping any songs we've already peeked at after it
+        self.history.insert(self.cursor, song)
+        self._played.add(song.id)
+        if len(self.history) > 2000: # don't keep an unbounded history
+            del self.history[:1000]
+            self.cursor -= 1000
+
+    def _draw(self): # take the next step of a Fisher-Yates shuffle of the slots, storing only the swapped entries
+        if self._generation != self.songs.generation: # the slots were renumbered, so start over, skipping played songs
+            (self._swaps, self._drawn, self._generation) = ({}, 0, self.songs.generation)
+        n = self.songs.slotCount()
+        while self._drawn < n:
+            j = self._rng.randrange(self._drawn, n)
+            value = self._swaps.pop(self._drawn, self._drawn)
+            if j != self._drawn: (value, self._swaps[j]) = (self._swaps.get(j, j), value)
+            self._drawn += 1
+            song = self.songs.atSlot(value)
+            if song is not None and song.id not in self._played:
+                self._played.add(song.id)
+                return song
+        return None
+
+    def _newPass(self, seed=None):
+        self.seed = seed if seed is not None else random.randrange(1 << 32)
+        self._rng = random.Random(self.seed)
+        (self._swaps, self._drawn, self._played) = ({}, 0, set())
+        self._generation = self.songs.generation
+
+    def _previousIndex(self):
+        i = self.cursor - 1
+        while i >= 0 and self.history[i] not in self.songs: i -= 1
+        return i
+
+# the playlist is saved as a file of paths plus a journal of changes made since, with lines '+path' (add), '-path'
+# (remove) and 'c' (clear), so a change appends a few bytes rather than rewriting the file. once the journal gets long, or
+# after changes the journal can't express (like reordering), the file is rewritten atomically and the journal deleted.
+# replaying the journal over a file that already includes it gives the same result, so a crash in between is harmless
 class Playlist:
-    def __init__(self, playlistFile, library):
-        self.songs = []
-        self.paths = {}
+    def __init__(self, playlistFile, library, loading=False):
+        self.songs = SongList()
         self.index = 0
+        self.library = library
+        self.shuffled = None # a Shuffle if we're playing in random order. the order of 'songs' is never changed
+        self._pending = None # while the library is loading, the paths from the playlist file (in order) -> Song or None
+        self._journal = [] # changes not yet written to the journal
+        (self._journaled, self._rewrite) = (0, False)
         if playlistFile:
+            self.playlistFile = playlistFile
             if library:
                 try:
                     with open(playlistFile) as file:
-                        songsByPath = {}
-                        for g in library.groups.values():
-                            for s in g.songs: songsByPath[s.path] = s
-                        while True:
-                            line = file.readline()
-                            if not line: break
-                            song = songsByPath.get(line[0:-1]) # strip \n
-                            if song:
-                                self.paths[song.path] = len(self.songs)
-                                self.songs.append(song)
-                except FileNotFoundError: pass
-                self.index = max(0, min(self.index, len(self.songs)-1))
-            self.playlistFile = playlistFile
+                        self._pending = {line[0:-1]: None for line in file if len(line) > 1} # strip \n
+                except FileNotFoundError: self._pending = {}
+                if self._replay(): self._compact()
+                if not loading: self.bind(final=True)
 
-    def add(self, songs, moveTo=False):
+    def add(self, songs, moveTo=False): # 'moveTo' is True to make the first song current, or the one of them to make current
         if type(songs) == Song: songs = (songs,)
         elif type(songs) == Group: songs = songs.songs
-        firstSong = None
+        firstSong = moveTo if isinstance(moveTo, Song) else None
         for song in songs:
             if firstSong is None: firstSong = song
-            if song.path not in self.paths:
-                if moveTo: self.index = len(self.songs)
-                self.paths[song.path] = len(self.songs)
+            move = moveTo is True or moveTo is song
+            index = self.songs.position(song)
+            if index is None:
+                if move: self.index = len(self.songs)
                 self.songs.append(song)
-            elif moveTo: self.index = self.paths[song.path]
-            moveTo = False
+                self._journal.append('+' + song.path)
+            elif move: self.index = index
+            if move:
+                if self.shuffled: self.shuffled.setCurrent(song) # only the song that will play goes in the history
+                moveTo = False
         return firstSong
 
+    def bind(self, final=False): # resolve paths from the playlist file against the songs loaded so far
+        if self._pending is None: return
+        for path, song in self._pending.items():
+            if song is None: self._pending[path] = self.library.findSong(path)
+        current = self.getCurrent()
+        L = [s for s in self._pending.values() if s is not None]
+        L.extend(s for s in self.songs if s.path not in self._pending) # keep songs added while loading after the others
+        self.songs.reset(L)
+        if current is not None: self.index = self.songs.position(current)
+        self.index = max(0, min(self.index, len(self.songs)-1))
+        if final: self._pending = None
+
     def clear(self):
         self.songs.clear()
-        self.paths.clear()
         self.index = 0
+        if self._pending is not None: self._pending.clear()
+        if self.shuffled: self.shuffled = Shuffle(self.songs)
+        self._journal.append('c')
 
-    def remove(self, songs):
+    def remove(self, songs): # the current song stays current if it's not removed. otherwise, the next one becomes current
         if type(songs) == Song: songs = (songs,)
         elif type(songs) == Group: songs = songs.songs
-        if len(songs) == 1:
-            index = self.paths.get(songs[0].path)
-            if index >= 0:
-                self.paths.pop(songs[0].path)
-                self.songs.remove(self.songs[index])
-                if index == self.index and index == len(self.songs): self.index -= 1
-                for p,i in self.paths.items():
-                    if i > index: self.paths[p] -= 1
-        else:
-            for song in songs:
-                index = self.paths.get(song.path)
-                if index >= 0:
-                    self.paths.pop(song.path)
-                    if index > self.index or index == len(self.songs): self.index -= 1
-            L = [self.songs[i] for i in self.paths.values()]
-            self.paths = {L[i].path:i for i in range(len(L))}
-            self.songs.clear() # avoid changing the self.songs reference, since others may have a reference to it
-            self.songs.extend(L)
+        for song in songs:
+            index = self.songs.remove(song)
+            if self._pending is not None and song.path in self._pending: del self._pending[song.path]
+            elif index is None: continue
+            self._journal.append('-' + song.path)
+            if index is not None and (index < self.index or index == self.index == len(self.songs)): self.index -= 1
         if not self._validIndex(): self.index = 0
 
-    def contains(self, song): return song.path in self.paths
+    def contains(self, song): return song in self.songs
     def count(self): return len(self.songs)
+    def replace(self, old, new): # point an entry at the song it was renamed to
+        if old not in self.songs: return False
+        if new in self.songs: self.remove(old)
+        else:
+            self.songs.replace(old, new)
+            self._rewrite = True
+        return True
+
     def getCurrent(self): return self.songs[self.index] if self._validIndex() else None
     def isempty(self): return len(self.songs) == 0
 
+    def next(self, step=1, wrap=False): # returns the index of the song to play after (or before) the current one, or None
+        if self.isempty(): return None
+        if self.shuffled is None:
+            index = self.index + step
+            return index % len(self.songs) if wrap else index if index >= 0 and index < len(self.songs) else None
+        song = self.shuffled.next(wrap, advance=False) if step > 0 else self.shuffled.previous(advance=False)
+        return self.songs.position(song) if song else None
+
     def save(self, playlistFile=None):
-        if playlistFile is None: playlistFile = self.playlistFile
-        with open(playlistFile, 'w') as file:
-            for s in self.songs: file.write(s.path + "\n")
+        if playlistFile is not None and playlistFile != self.playlistFile:
+            with open(playlistFile, 'w') as file: file.writelines(p + "\n" for p in self._paths())
+        elif self._rewrite or self._journaled + len(self._journal) > _journalLimit: self._compact()
+        elif self._journal:
+            with open(self.playlistFile + '.journal', 'a') as file:
+                file.writelines(op + "\n" for op in self._journal)
+                file.flush()
+                os.fsync(file.fileno())
+            self._journaled += len(self._journal)
+            self._journal.clear()
 
     def select(self, item):
         newIndex = item
-        if isinstance(item, Song): newIndex = self.paths.get(song.path)
-        elif isinstance(item, str): newIndex = self.paths.get(item)
+        if isinstance(item, Song): newIndex = self.songs.position(item)
+        elif isinstance(item, str):
+            song = self.library.findSong(item)
+            newIndex = self.songs.position(song) if song else None
         if newIndex is None or newIndex < 0 or newIndex >= len(self.songs): return False
         self.index = newIndex
+        if self.shuffled: self.shuffled.setCurrent(self.songs[newIndex])
         return True
 
-    def shuffle(self, changeSong=False):
-        i = 0
-        while i < len(self.songs):
-            j = random.randint(i, len(self.songs)-1)
-            if i != j:
-                (a, b) = (self.songs[i], self.songs[j])
-                (self.songs[i], self.songs[j], self.paths[a.path], self.paths[b.path]) = (b, a, j, i)
-                if not changeSong:
-                    if self.index == i: self.index = j
-                    elif self.index == j: self.index = i
-            i += 1
+    def setShuffle(self, on, state=None): # 'state' is from a previous Shuffle.state(), to resume where it left off
+        self.shuffled = Shuffle(self.songs) if on else None
+        if on:
+            if isinstance(state, dict): self.shuffled.restore(state) # older versions saved a list we can't use
+            current = self.getCurrent()
+            if current: self.shuffled.setCurrent(current)
+
+    def _compact(self): # rewrite the playlist file atomically and start a new journal
+        with open(self.playlistFile + '.tmp', 'w') as file:
+            file.writelines(p + "\n" for p in self._paths())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.playlistFile + '.tmp', self.playlistFile)
+        try: os.remove(self.playlistFile + '.journal')
+        except FileNotFoundError: pass
+        self._journal.clear()
+        (self._journaled, self._rewrite) = (0, False)
+
+    def _paths(self):
+        if self._pending is not None: # don't forget songs whose groups haven't been loaded yet
+            yield from self._pending
+        for s in self.songs:
+            if self._pending is None or s.path not in self._pending: yield s.path
+
+    def _replay(self): # apply the journal to the paths read from the playlist file
+        try:
+            with open(self.playlistFile + '.journal') as file: lines = file.readlines()
+        except FileNotFoundError: return False
+        for line in lines:
+            if not line.endswith("\n"): break # the last write was cut off
+            (op, path) = (line[0], line[1:-1])
+            if op == '+': self._pending.setdefault(path, None)
+            elif op == '-': self._pending.pop(path, None)
+            elif op == 'c': self._pending.clear()
+        return True
 
     def _validIndex(self): return self.index >= 0 and self.index < len(self.songs)
+
+def _toRanges(ids): # turns sorted IDs into [start, count] pairs, which are compact since a pass's IDs become dense
+    ranges = []
+    for i in ids:
+        if ranges and ranges[-1][0] + ranges[-1][1] == i: ranges[-1][1] += 1
+        else: ranges.append([i, 1])
+    return ranges
+
+def _memoryPerSong(cls, count): # measures the bytes per song of the given class, with names like the scanner produces
+    import tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    songs = []
+    for i in range(count):
+        (artist, album) = ('Artist {}'.format(i // 120), 'Album {}'.format(i // 12))
+        songs.append(cls('Music/{}/{}/{:02d} - {} - Title {}.mp3'.format(artist, album, i % 12, artist, i), artist, 'Title ' + str(i)))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / count
+
+# python3 library.py ROOT [WORKERS] compares cold serial and parallel scans, and
+# python3 library.py --memory [SONGS] reports the memory used per song
+if __name__ == '__main__':
+    import time
+    if sys.argv[1] == '--memory':
+        class DictSong: # Song as it was before it used __slots__ and interned artist names
+            def __init__(self, path, artist, title):
+                self.path = path
+                self.artist = artist
+                self.title = title
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+        (before, after) = (_memoryPerSong(DictSong, count), _memoryPerSong(Song, count))
+        print('{} songs: {:.0f} bytes/song before, {:.0f} bytes/song after ({:.0f}% less)'.format(
+            count, before, after, (before-after)*100/before))
+        sys.exit(0)
+    (root, workers) = (sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    results = []
+    for n in (1, workers, 1, workers): # alternate so both modes see a similarly warm page cache
+        lib = Library(root)
+        start = time.monotonic()
+        lib.scan(n)
+        elapsed = time.monotonic() - start
+        results.append({k: [(s.path, s.artist, s.title) for s in g.songs] for k,g in lib.groups.items()})
+        print('{} worker(s): {:.3f} s, {} groups, {} songs, {} dirs'.format(
+            n, elapsed, len(lib.groups), sum(len(g.songs) for g in lib.groups.values()), len(lib._dirs)))
+    print('results identical' if all(r == results[0] for r in results) else 'RESULTS DIFFER')
@@ -0,0 +1,94 @@
+import collections
+import fcntl
+import glob
+import re
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+SIOCGIFADDR = 0x8915
+_throttledFile = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+
+class Sample:
+    def __init__(self):
+        self.time = time.monotonic()
+        self.load = None # the one-minute load average, as a string
+        self.memTotal = None # in kB
+        self.memUsed = None # in kB, not counting buffers and caches
+        self.freq = None # the CPU clock, in Hz
+        self.temp = None # the hottest thermal zone, in thousandths of a degree C
+        self.addr = None # our IPv4 address, or None
+        self.flags = 0 # throttling flags, as from 'vcgencmd get_throttled'
+
+# samples system statistics on a background thread by reading /proc and /sys directly, so showing them doesn't cost the
+# UI thread any forks. the last 'history' samples are kept. if the kernel doesn't expose the throttling flags, we run
+# vcgencmd for them, but only every 'slowInterval' seconds
+class Sampler:
+    def __init__(self, interval=5, history=60, interface='wlan0', slowInterval=60):
+        self.interval = interval
+        self.interface = interface
+        self.slowInterval = slowInterval
+        self.history = collections.deque(maxlen=history)
+        (self._flags, self._flagsTime) = (0, None)
+        self._quitEvent = threading.Event()
+        self._thread = None
+
+    def latest(self): return self.history[-1] if self.history else None
+
+    def start(self):
+        self._quitEvent.clear() # we may have been stopped before
+        self._thread = threading.Thread(target=self._main, name='MetricsSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._quitEvent.set()
+            self._thread.join()
+            self._thread = None
+
+    def sample(self):
+        s = Sample()
+        try:
+            with open('/proc/loadavg') as f: s.load = f.read().split()[0]
+        except OSError: pass
+        try:
+            with open('/proc/meminfo') as f: mem = {m[0]: int(m[1]) for m in re.findall(r'^(\w+):\s+([0-9]+)', f.read(), re.M)}
+            (s.memTotal, s.memUsed) = (mem['MemTotal'], mem['MemTotal'] - mem['MemAvailable'])
+        except (OSError, KeyError): pass
+        s.freq = _readInt('/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq')
+        if s.freq is not None: s.freq *= 1000 # it's in kHz
+        temps = [t for t in (_readInt(f) for f in glob.glob('/sys/class/thermal/thermal_zone*/temp')) if t is not None]
+        if temps: s.temp = max(temps)
+        s.addr = _address(self.interface)
+        s.flags = self._readFlags(s.time)
+        self.history.append(s)
+        return s
+
+    def _main(self):
+        while True:
+            self.sample()
+            if self._quitEvent.wait(self.interval): break
+
+    def _readFlags(self, now):
+        flags = _readInt(_throttledFile, 16)
+        if flags is not None: return flags
+        if self._flagsTime is None or now - self._flagsTime >= self.slowInterval: # fall back to vcgencmd, but rarely
+            self._flagsTime = now
+            try:
+                p = subprocess.run(['/usr/bin/vcgencmd', 'get_throttled'], capture_output=True, timeout=5)
+                m = re.search('=0x([0-9a-fA-F]+)$', p.stdout.decode('ascii').strip())
+                if m: self._flags = int(m.group(1), 16)
+            except (OSError, subprocess.SubprocessError): pass
+        return self._flags
+
+def _address(interface): # returns the interface's IPv4 address, or None if it doesn't have one
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try: return socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', interface.encode()[:15]))[20:24])
+        except OSError: return None
+
+def _readInt(path, base=10):
+    try:
+        with open(path) as f: return int(f.read().strip(), base)
+    except (OSError, ValueError): return None
@@ -0,0 +1,109 @@
+import time
+import urllib.parse
+import vlc
+
+_Stopped = (vlc.State.Ended, vlc.State.Stopped, vlc.State.Error) # states in which play() opens the media again
+
+class Event: # something that happened in one of the engine's players, posted from vlc's thread to be handled on the UI's
+    EndReached = 'end'
+    Error = 'error'
+    LengthChanged = 'length'
+    TimeChanged = 'time'
+
+    def __init__(self, kind, player, value=None):
+        self.kind = kind
+        self.player = player
+        self.value = value # the new time or length, in milliseconds
+
+# plays songs through two MediaPlayers. while one plays, the next song is opened in the other and paused at its start,
+# so when the current song ends we just unpause the other one rather than waiting for a file to be opened and decoded.
+# the UI decides what plays next (following the playlist's order, repeat and shuffle) and when to switch.
+# the players' events are passed to onEvent(Event) on vlc's threads, and the UI should give them back to handle() on its
+# own thread, which keeps track of the players' times and lengths so nobody has to ask vlc
+class Engine:
+    def __init__(self, library, onEvent):
+        self.library = library
+        self.current = vlc.MediaPlayer()
+        self.nextSong = None # the song waiting in the other player, or None
+        self.volume = 100
+        self._next = self.current.get_instance().media_player_new()
+        self._held = None # the player whose media was preloaded with ':start-paused', which vlc applies on every play()
+        self._state = {} # player -> [song, time, length, when the time was reported]
+        for player in (self.current, self._next):
+            self._state[player] = [None, 0, 0, None]
+            events = player.event_manager()
+            for (type, kind, value) in ((vlc.EventType.MediaPlayerEndReached, Event.EndReached, None),
+                                        (vlc.EventType.MediaPlayerEncounteredError, Event.Error, None),
+                                        (vlc.EventType.MediaPlayerLengthChanged, Event.LengthChanged, lambda e: e.u.new_length),
+                                        (vlc.EventType.MediaPlayerTimeChanged, Event.TimeChanged, lambda e: e.u.new_time)):
+                events.event_attach(type, lambda e, p=player, k=kind, v=value: onEvent(Event(k, p, v(e) if v else None)))
+
+    def media(self, song): return self.current.get_instance().media_new(self.mrl(song))
+    def mrl(self, song): return 'file://' + urllib.parse.quote(self.library.getPath(song))
+
+    def handle(self, e): # records an event's time or length, and returns True if it's about the current player
+        state = self._state[e.player]
+        if e.kind == Event.TimeChanged: (state[1], state[3]) = (e.value, time.monotonic())
+        elif e.kind == Event.LengthChanged: state[2] = e.value
+        elif e.kind == Event.Error and e.player is self._next: state[0] = None # so we won't switch to a song that can't play
+        return e.player is self.current
+
+    def load(self, song): # puts a song in the current player without starting it
+        self.current.set_media(self.media(song))
+        self._state[self.current][:] = [song, 0, 0, None]
+        if self._held is self.current: self._held = None
+
+    def play(self): # starts or resumes the current song
+        song = self._state[self.current][0]
+        if self._held is self.current and song is not None and self.current.get_state() in _Stopped:
+            self.load(song) # it would start paused again, so replace it with a plain media
+        self.current.play()
+
+    def pause(self): # toggles pausing, like vlc's pause()
+        self.current.pause()
+        self._state[self.current][3] = None # the time is unknown until it's reported again
+
+    def position(self, song): # returns (time, length) in milliseconds if the song is in the current player, else None
+        state = self._state[self.current]
+        return (state[1], state[2]) if state[0] is song else None
+
+    def preload(self, song): # get a song ready to play next, or pass None to forget the one we have
+        if song is self.nextSong: return
+        self._next.stop()
+        self.nextSong = song
+        self._state[self._next][:] = [song, 0, 0, None]
+        if song is not None:
+            media = self.media(song)
+            media.add_option(':start-paused') # open it and decode the start, but don't play it yet
+            self._next.set_media(media)
+            self._held = self._next
+            self._next.audio_set_volume(self.volume)
+            self._next.play()
+
+    def remaining(self): # returns the milliseconds left in the current song assuming it's playing, or None if not known
+        (song, ms, length, when) = self._state[self.current]
+        if length <= 0 or when is None: return None
+        return max(0, length - ms - (time.monotonic() - when)*1000) # vlc only reports the time every so often
+
+    def seek(self, ms):
+        self.current.set_time(int(ms))
+        state = self._state[self.current]
+        (state[1], state[3]) = (int(ms), state[3] and time.monotonic())
+
+    def setVolume(self, volume):
+        self.volume = volume
+        self.current.audio_set_volume(volume)
+        self._next.audio_set_volume(volume)
+
+    def stop(self):
+        self.current.stop()
+        state = self._state[self.current]
+        (state[1], state[3]) = (0, None)
+
+    def switch(self): # starts the preloaded song and makes it current, returning it, or None if nothing was preloaded
+        song = self.nextSong
+        if song is None or self._state[self._next][0] is not song: return None
+        self._next.set_pause(0)
+        self.current.stop()
+        (self.current, self._next, self.nextSong) = (self._next, self.current, None)
+        return song
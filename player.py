@@ -1,18 +1,25 @@
+import bisect
 import bluetooth
 import buttons
+import cache
 import display
+import durations
 import json
 import library
+import metrics
 import os
+import playback
 import queue
 import random
 import re
 import signal
 import subprocess
 import sys
+import tags
+import threading
 import time
-import urllib.parse
-import vlc
+import timers
+import watcher
 
 _C = display.Display
 _Background = _C.Black
@@ -20,7 +27,10 @@ _Selected = _C.White
 _Unselected = _C.Gray
 _SelArtist = (255,216,164)
 _UnselArtist = (128,108,82)
+_Lead = 0.05 # seconds before the end of a song that we start the next one, to allow for timer latency
 _numRe = re.compile('^[0-9]+ - ')
+_wordRe = re.compile(r'\b[0-9a-z]', re.I)
+_fold = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ\u0130\u0131\u212a\u017f', 'abcdefghijklmnopqrstuvwxyziiks') # as re.I matches
 
 class Menu:
     def __init__(self): self.headerSize = 0
@@ -32,13 +42,15 @@ class Menu:
     def enter(self, firstTime): self.paint()
     def leave(self): pass
     def onBluetoothEvent(self, dev, op): pass
+    def onLibraryChanged(self, change=None): pass
+    def onPlayerEvent(self, e): pass
     def onPress(self, btn): pass
-    def paint(self):
+    def paint(self): self.ui.requestPaint(self) # the UI will call render() once it's handled the events it has
+    def paintCore(self): pass
+    def render(self):
         self.ui.clear()
         self.paintCore()
         self.d.flip()
-    def paintCore(self): pass
-    def tick(self): pass
 
     def center(self, item, color, font=None, y=None):
         if type(item) == str: item = self.measure(item, font)
@@ -49,7 +61,15 @@ class Menu:
             y += h
         return (startY, item[0])
 
-    def measure(self, s, font=None):
+    def measure(self, s, font=None): # returns (height, ((line, width, height), ...)) with the text wrapped to fit the screen
+        key = (s, font, self.d.width)
+        layout = self.ui.layouts.get(key)
+        if layout is None:
+            layout = self._wrap(s, font)
+            self.ui.layouts.put(key, layout)
+        return layout
+
+    def _wrap(self, s, font):
         (w,h) = self.d.textsize(s, font)
         if w <= self.d.width: return (h,((s,w,h),))
         words = s.split()
@@ -73,10 +93,13 @@ class Menu:
         if line:
             lines.append((line, x, lh))
             h += lh
-        return (h,lines)
+        return (h,tuple(lines))
 
 class LoadingMenu(Menu):
-    def paintCore(self): self.d.center('Loading...', _C.White)
+    def paintCore(self):
+        (y,h) = self.d.center('Loading...', _C.White)
+        (dirs, songs) = self.ui.loadProgress
+        if dirs: self.center('{} folders, {} songs'.format(dirs, songs), _C.Gray, self.ui.smallFont, y+h+4)
 
 class ListMenu(Menu):
     class _collapsed:
@@ -84,6 +107,29 @@ class ListMenu(Menu):
             self.keys = keys
             self.group = group
 
+    class _wordIndex: # finds the keys having a word that starts with a prefix, like searching for r'\b'+prefix with re.I
+        Length = 16 # how much of each word to index. longer prefixes are checked against the keys
+
+        def __init__(self, keys):
+            words = []
+            for i, key in enumerate(keys):
+                folded = key.translate(_fold)
+                words.extend((folded[m.start():m.start()+self.Length], i) for m in _wordRe.finditer(key))
+            words.sort()
+            self.keys = keys
+            self.words = [w for w, i in words]
+            self.indexes = [i for w, i in words]
+
+        def find(self, prefix): # returns the matching keys in their original order. the prefix must start with [0-9a-z]
+            p = prefix[:self.Length].translate(_fold)
+            start = bisect.bisect_left(self.words, p)
+            end = bisect.bisect_left(self.words, p[:-1] + chr(ord(p[-1]) + 1), start) # the first word after the prefix
+            keys = [self.keys[i] for i in sorted(set(self.indexes[start:end]))]
+            if len(prefix) > self.Length:
+                rgx = re.compile(r'\b' + prefix, re.I)
+                keys = [key for key in keys if rgx.search(key)]
+            return keys
+
     def __init__(self):
         super().__init__()
         self.collapse = False
@@ -94,13 +140,17 @@ class ListMenu(Menu):
         self.sort = False
         self.stack = None
         self.vindex = 0
+        (self._lists, self._listVersion) = (None, None)
 
     def enter(self, firstTime):
-        if firstTime: self.refreshList(False)
+        if firstTime:
+            self.stack = None # we may be a menu that's being reused
+            self.refreshList(False)
         super().enter(firstTime)
 
     def getColor(self, key, selected): return _Selected if selected else _Unselected
     def getItems(self): return {}
+    def itemsVersion(self): return None # a value that changes whenever getItems() would, or None if it can't be known
 
     def onPress(self, btn):
         newVIndex = self.vindex
@@ -112,7 +162,7 @@ class ListMenu(Menu):
         elif btn == _C.A or btn == _C.C:
             value = self.items[self.keys[self.index]]
             if self.collapse and isinstance(value, ListMenu._collapsed):
-                self._setList({k:self.origItems[k] for k in value.keys}, len(self.stack)+1 if self.stack else 1, value.group)
+                self._setList(lambda: {k:self.origItems[k] for k in value.keys}, len(self.stack)+1 if self.stack else 1, value.group)
                 (newVIndex, repaint) = (self._initialIndex(), True)
             else:
                 self.onSelected(self.keys[self.index], value, btn)
@@ -152,7 +202,7 @@ class ListMenu(Menu):
     def refreshList(self, repaint=True):
         oldKey = None
         if not self.keepIndex and self.keys is not None and len(self.keys): oldKey = self.keys[self.index]
-        self._setList(self.getItems())
+        self._setList(self.getItems)
         if self.keepIndex:
             self.index = max(0, min(len(self.keys)-1, self.index))
         elif oldKey is not None:
@@ -170,22 +220,34 @@ class ListMenu(Menu):
                len(i.songs) if type(i) == library.Group else len(i) if type(i) == list else 1
         return -sorted(((ilen(self.items[self.keys[i]]), -i) for i in range(len(self.keys))), reverse=True)[0][1]
 
-    def _setList(self, items, depth=0, prevBucket=None):
+    def _setList(self, getItems, depth=0, prevBucket=None): # the bucketed lists are remembered until itemsVersion() changes
         if depth:
             if self.stack is None: self.stack = []
             self.stack.append((self.index, self.items, self.keys))
+        version = self.itemsVersion()
+        if version is not None and version != self._listVersion: (self._lists, self._listVersion) = (cache.LRUCache(32), version)
+        cached = self._lists.get((depth, prevBucket)) if version is not None else None
+        if cached is not None:
+            (self.items, self.keys) = cached[0:2]
+            if depth == 0: (self.origItems, self.words) = cached[2:]
+            return
+        self._buildList(getItems(), depth, prevBucket)
+        if version is not None:
+            self._lists.put((depth, prevBucket), (self.items, self.keys, getattr(self, 'origItems', None), getattr(self, 'words', None)))
+
+    def _buildList(self, items, depth, prevBucket):
         self.items = items
         self.keys = list(items.keys())
         (count, threshold) = (len(items), 10 if self.collapse == 'substr' else 20)
         if self.collapse and count > threshold:
             buckets = {}
             if self.collapse == 'substr':
+                if depth == 0: self.words = ListMenu._wordIndex(self.keys)
                 letters = '0123456789abcdefghijklmnopqrstuvwxyz'
                 if depth: letters = " '" + letters
                 for c in letters:
-                    sub = prevBucket + c if prevBucket else c
-                    rgx = re.compile(r'\b' + sub, re.I) # pure substring search is a bit weird so use the starts of words
-                    bucket = [key for key in self.keys if rgx.search(key)]
+                    sub = prevBucket + c if prevBucket else c # pure substring search is a bit weird so use the starts of words
+                    bucket = [key for key in self.words.find(sub) if key in items]
                     if len(bucket): buckets[sub] = bucket
             else:
                 keyfn = lambda prefix: prefix + '...'
@@ -297,19 +359,23 @@ class RootMenu(Menu):
 
     def init(self, ui):
         self._numHeight = ui.display.textsize('0123456789:')[1]
+        self._shown = None
         super().init(ui)
 
+    def onLibraryChanged(self, change=None):
+        if self is self.ui.menu(): self.paint()
+
+    def onPlayerEvent(self, e): # repaint only if the time shown or the progress bar would change
+        if self._shown != self._progress(self.ui.playlist.getCurrent()): self.paint()
+
     def onPress(self, btn):
         if btn == _C.U or btn == _C.D:
             if btn == _C.U: self.ui.previousTrack(canRewind=True)
             elif btn == _C.D: self.ui.nextTrack()
         elif btn == _C.L or btn == _C.R:
-            if self.ui.player.is_playing():
-                media = self.ui.player.get_media()
-                duration = media.get_duration()
-                pos = max(0, self.ui.player.get_position()) * duration
-                newpos = max(0, min(duration, pos + (-5000 if btn == _C.L else 5000)))
-                self.ui.player.set_position(newpos / duration)
+            pos = self.ui.playback.position(self.ui.playlist.getCurrent())
+            if pos and pos[1] > 0 and self.ui.player.is_playing():
+                self.ui.playback.seek(max(0, min(pos[1], pos[0] + (-5000 if btn == _C.L else 5000))))
                 self.paint()
         elif btn == _C.A or btn == _C.C:
             current = self.ui.playlist.getCurrent()
@@ -334,27 +400,21 @@ class RootMenu(Menu):
             self.center(artist, _C.Gray, y=y)
             self.center(title, _C.White, self.ui.bigFont, y + artist[0] + 2)
 
-            media = self.ui.ensureMedia(song)
-            duration = media.get_duration()
+            self._shown = self._progress(song)
+            (pos, duration, width) = self._shown
             if duration > 0:
-                frac = max(0, self.ui.player.get_position())
-                pos = frac * duration
-                remStr = timeStr(duration - pos)
+                remStr = timeStr((duration - pos) * 1000)
                 (w, y) = (self.d.textsize(remStr)[0], self.d.height - self._numHeight - 4)
-                if pos > 0: self.d.rect(0, y - 1, int(self.d.width*frac), self.d.height - (y-1), (32, 48, 128))
-                self.d.text(1, y, timeStr(pos), _C.White)
+                if width > 0: self.d.rect(0, y - 1, width, self.d.height - (y-1), (32, 48, 128))
+                self.d.text(1, y, timeStr(pos * 1000), _C.White)
                 self.d.text(self.d.width-w-1, y, remStr, _C.White)
 
-    def tick(self):
-        if not self.ui.pendingPlay:
-            isPlaying = self.ui.player.is_playing()
-            if isPlaying or self.ui.shouldBePlaying:
-                if not isPlaying:
-                    newIndex = self.ui.playlist.index + 1
-                    if self.ui.repeat and newIndex >= self.ui.playlist.count(): newIndex = 0
-                    if self.ui.selectSong(newIndex) >= 0: self.ui.playCurrent()
-                    else: self.ui.stopPlaying()
-                self.paint()
+    def _progress(self, song): # returns the (seconds, duration in seconds, width of the progress bar) to show
+        if not song: return None
+        pos = self.ui.playback.position(song)
+        (ms, duration) = pos if pos and pos[1] > 0 else (0, self.ui.durations.get(song))
+        if not duration: return (0, 0, 0)
+        return (int(ms*0.001 + 0.5), int(duration*0.001 + 0.5), int(self.d.width * min(1, max(0, ms) / duration)))
 
 class MainMenu(ListMenu):
     def __init__(self):
@@ -384,6 +444,9 @@ class MainMenu(ListMenu):
         for k in ('System','Sleep','Exit'): d[k] = None
         return d
 
+    def onLibraryChanged(self, change=None):
+        if self is self.ui.menu(): self.refreshList()
+
     def onPress(self, btn):
         if self.locked:
             if btn == _C.A or btn == _C.B or btn == _C.C:
@@ -406,7 +469,7 @@ class MainMenu(ListMenu):
     def onSelected(self, key, value, btn):
         if key == 'Playlist': self.ui.push(GroupMenu(self.ui.playlist.songs, playlist=True))
         elif key == 'Library':
-            if len(self.ui.library.groups) != 1: self.ui.push(LibraryMenu())
+            if len(self.ui.library.groups) != 1 or self.ui.scanning: self.ui.push(LibraryMenu())
             else: self.ui.push(GroupMenu(next(iter(self.ui.library.groups.values())).songs))
         elif key == 'Bluetooth': self.ui.push(BluetoothMenu())
         elif key == 'System': self.ui.push(SystemMenu())
@@ -414,8 +477,7 @@ class MainMenu(ListMenu):
         elif key == 'Exit': self.ui.exit()
         elif key.startswith('Shuffle'):
             self.ui.shuffle = not self.ui.shuffle
-            self.ui.saveSettings()
-            if self.ui.shuffle: self.ui.shuffleSongs(not self.ui.player.is_playing())
+            self.ui.shuffleSongs(self.ui.shuffle and not self.ui.player.is_playing())
             self.refreshList()
         elif key.startswith('Repeat'):
             self.ui.repeat = not self.ui.repeat
@@ -429,28 +491,22 @@ class MainMenu(ListMenu):
             self.refreshList()
 
 class SystemMenu(Menu):
-    def __init__(self):
-        super().__init__()
-        self.ticks = 0
+    def enter(self, firstTime):
+        super().enter(firstTime)
+        self.timer = self.ui.timers.every(5, lambda n: self.paint()) # repaint every 5 seconds
+
+    def leave(self): self.timer.cancel()
 
     def paintCore(self):
-        addr = None
-        if self.ui.isWifiEnabled:
-            addr = subprocess.run(['/usr/sbin/ifconfig', 'wlan0'], capture_output=True)
-            addr = re.search('\sinet\s+([0-9]{1,3}(?:\.[0-9]{1,3}){3})\s', addr.stdout.decode('ascii'))
-            if addr: addr = addr.group(1)
-        freq = subprocess.run(['/usr/bin/vcgencmd', 'measure_clock', 'arm'], capture_output=True)
-        freq = int(re.search('=([0-9]+)$', freq.stdout.decode('ascii')).group(1))
-        load = subprocess.run(['/usr/bin/uptime'], capture_output=True)
-        load = re.search('load average:\s*([0-9]+(?:\.[0-9]*)?)', load.stdout.decode('ascii')).group(1)
-        mem = subprocess.run(['/usr/bin/free', '-wk'], capture_output=True)
-        mem = re.search('Mem:\s*([0-9]+)\s+([0-9]+)', mem.stdout.decode('ascii'))
-        flags = subprocess.run(['/usr/bin/vcgencmd', 'get_throttled'], capture_output=True)
-        flags = int(re.search('=0x([0-9]+)$', flags.stdout.decode('ascii')).group(1), 16)
-        with open('/sys/class/thermal/thermal_zone0/temp') as f: temp = int(f.read())
+        sample = self.ui.metrics.latest()
+        if sample is None or sample.memTotal is None:
+            self.d.center('Measuring...', _C.White)
+            return
+        addr = sample.addr if self.ui.isWifiEnabled else None
+        (freq, load, temp, flags) = (sample.freq or 0, sample.load or '?', sample.temp or 0, sample.flags)
 
         (y,h) = self.center(
-            'Mem: ' + str(int(int(mem.group(2))/102.4+0.5)/10) + ' / ' + str(int(int(mem.group(1))/1024+0.5)) + ' MB', _C.White)
+            'Mem: ' + str(int(sample.memUsed/102.4+0.5)/10) + ' / ' + str(int(sample.memTotal/1024+0.5)) + ' MB', _C.White)
         load = self.measure('CPU: ' + load + ' @ ' + str((freq+5000000)//10000000/100) + ' ghz')
         self.center(load, _C.White, y=y-load[0]-4)
         if addr:
@@ -468,14 +524,14 @@ class SystemMenu(Menu):
                 return s
             color = _C.Red if flags & 9 else _C.Orange if flags & 0x90000 else _C.Yellow if flags & 6 else _C.White
             self.center('Flags: ' + decode(flags) + decode(flags >> 16).lower(), color, y=d[0]+d[1]+4)
+        stats = self.ui.stats
+        stats = self.measure('{} events, {} paints ({} merged)'.format(
+            stats['events'], stats['paints'], stats['paintsMerged']), self.ui.smallFont)
+        self.center(stats, _C.Gray, self.ui.smallFont, y=self.d.height-stats[0]-1)
 
     def onPress(self, btn):
         if btn == _C.B: self.ui.pop()
 
-    def tick(self):
-        self.ticks += 1
-        if self.ticks % 5 == 0: self.paint() # repaint every 5 seconds
-
 class MusicMenu(ListMenu):
     def __init__(self, songs, playlist=False, trimNumbers=False):
         super().__init__()
@@ -484,6 +540,31 @@ class MusicMenu(ListMenu):
         self.sort = True
         self.playlist = playlist
         self.trimNumbers = trimNumbers
+        self.stale = False
+
+    def enter(self, firstTime):
+        if not firstTime and self.stale: self.refreshList(False)
+        super().enter(firstTime)
+
+    def onLibraryChanged(self, change=None):
+        if self.isAffected(change):
+            self.stack = None # the buckets we've drilled into may no longer exist
+            if self is self.ui.menu(): self.refreshList()
+            self.stale = self is not self.ui.menu()
+
+    def itemsVersion(self): # the playlist can change without the library changing
+        return self.ui.library.version if self.songs is not self.ui.playlist.songs else None
+
+    def isAffected(self, change):
+        if change is None: return True
+        if self.songs is self.ui.playlist.songs: return change.playlistChanged
+        for g in change.groups:
+            if g.songs is self.songs: return True
+        removed = set(change.removed) # otherwise it's a list we derived, so drop songs that are gone
+        changed = removed.union(change.retagged)
+        if not any(s in changed for s in self.songs): return False
+        if removed: self.songs[:] = [s for s in self.songs if s not in removed]
+        return True
 
     def onSelected(self, key, value, btn):
         if btn == _C.A:
@@ -503,42 +584,29 @@ class LibraryMenu(MusicMenu):
         self.sort = False
 
     def getItems(self):
-        all = []
-        for group in self.ui.library.groups.values(): all.extend(group.songs)
-        d = {'All': library.Group('All', all)}
-        for g in sorted(self.ui.library.groups.values(), key=lambda g: g.name): d[g.name] = g
+        d = {'All': self.ui.library.all()}
+        for g in self.ui.library.sortedGroups(): d[g.name] = g
         return d
 
+    def isAffected(self, change): return True
+
     def onSelected(self, key, value, btn):
         if btn == _C.A: super().onSelected(key, value, btn)
-        else: self.ui.push(GroupMenu(value.songs))
+        else: self.ui.push(self.ui.cachedMenu(GroupMenu, value.songs))
 
 class ArtistMenu(MusicMenu):
-    def getItems(self):
-        d = {}
-        for s in self.songs:
-            L = d.get(s.artist)
-            if not L: d[s.artist] = L = []
-            L.append(s)
-        return d
+    def getItems(self): return self.ui.library.view('artists', self.songs)
 
     def onSelected(self, artist, songs, btn):
         if btn == _C.A: super().onSelected(artist, songs, btn)
-        else: self.ui.push(SongMenu(songs, trimNumbers=True))
+        else: self.ui.push(self.ui.cachedMenu(SongMenu, songs, trimNumbers=True))
 
 class FolderMenu(MusicMenu):
-    def getItems(self):
-        d = {}
-        for s in self.songs:
-            folder = os.path.basename(os.path.dirname(s.path))
-            L = d.get(folder)
-            if not L: d[folder] = L = []
-            L.append(s)
-        return d
+    def getItems(self): return self.ui.library.view('folders', self.songs)
 
     def onSelected(self, folder, songs, btn):
         if btn == _C.A: super().onSelected(folder, songs, btn)
-        else: self.ui.push(SongMenu(songs, self.playlist))
+        else: self.ui.push(self.ui.cachedMenu(SongMenu, songs, self.playlist))
 
 class GroupMenu(MusicMenu):
     def  __init__(self, songs, playlist=False):
@@ -556,10 +624,13 @@ class GroupMenu(MusicMenu):
         if self.playlist: d['Clear'] = None
         return d
 
+    def isAffected(self, change): return False # our items don't depend on the songs
+    def itemsVersion(self): return 0
+
     def onSelected(self, key, value, btn):
-        if key == 'Artists': self.ui.push(ArtistMenu(self.songs, self.playlist))
-        elif key == 'Find': self.ui.push(FindMenu(self.songs, self.playlist))
-        elif key == 'Folders': self.ui.push(FolderMenu(self.songs, self.playlist))
+        if key == 'Artists': self.ui.push(self.ui.cachedMenu(ArtistMenu, self.songs, self.playlist))
+        elif key == 'Find': self.ui.push(self.ui.cachedMenu(FindMenu, self.songs, self.playlist))
+        elif key == 'Folders': self.ui.push(self.ui.cachedMenu(FolderMenu, self.songs, self.playlist))
         elif key == 'Clear':
             self.ui.clearSongs()
             self.ui.pop()
@@ -570,7 +641,7 @@ class GroupMenu(MusicMenu):
             menu.index = self.ui.playlist.index
             self.ui.push(menu)
         elif btn == _C.A and not self.playlist: super().onSelected(None, self.songs, btn)
-        else: self.ui.push(SongMenu(self.songs, playlist=self.playlist, trimNumbers=True))
+        else: self.ui.push(self.ui.cachedMenu(SongMenu, self.songs, playlist=self.playlist, trimNumbers=True))
 
 class PlayMenu(ListMenu):
     def __init__(self, songs, h1=None, h2=None, playlist=False, trimNumbers=False):
@@ -640,16 +711,12 @@ class FindMenu(SongMenu):
 
     def getItems(self):
         d = super().getItems()
-        for s in self.songs:
-            L = d.get(s.artist)
-            if not L: d[s.artist] = L = []
-            elif type(L) != list: continue
-            L.append(s)
+        for artist, L in self.ui.library.view('artists', self.songs).items(): d.setdefault(artist, L) # titles win
         return d
 
     def onSelected(self, key, value, btn):
         if btn == _C.A or type(value) != list: super().onSelected(key, value, btn)
-        else: self.ui.push(SongMenu(value, trimNumbers=True))
+        else: self.ui.push(self.ui.cachedMenu(SongMenu, value, trimNumbers=True))
 
 class UI:
     def __init__(self):
@@ -661,15 +728,34 @@ class UI:
         self.display.power(True)
         self.smallFont = self.display.font.font_variant(size=16)
         self.bigFont = self.display.font.font_variant(size=30)
+        self.loadProgress = (0, 0)
+        self.stats = {'events': 0, 'batches': 0, 'paints': 0, 'paintsMerged': 0}
+        self._paint = None # whether a paint was requested during this batch of events, or None if we're not in a batch
+        self.timers = timers.Scheduler()
+        self.metrics = metrics.Sampler()
+        self._idleTimer = None # puts us to sleep once we've been idle for a while
+        self._indexTimer = None # pending write of the library index
+        self.menus = cache.LRUCache(8) # recently built menus, so going back and forth between them is quick
+        self.layouts = cache.LRUCache(512) # (text, font, width) -> wrapped lines from Menu.measure()
         self.stack = [LoadingMenu()]
         self.menu().init(self)
-        self.library = library.Library('/home/pi/music')
-        self.scanner = bluetooth.Scanner(onAdded=lambda s,d: self.bluetoothEvent(d, 'A'),
+        self.library = library.Library('/home/pi/music', '/home/pi/.library', workers=4)
+        scanner = bluetooth.DBusScanner if bluetooth.dbus is not None else bluetooth.Scanner # prefer D-Bus to bluetoothctl
+        self.scanner = scanner(onAdded=lambda s,d: self.bluetoothEvent(d, 'A'),
             onChanged=lambda s,d: self.bluetoothEvent(d, 'C'), onRemoved=lambda s,d: self.bluetoothEvent(d, 'R'))
         self.buttons = buttons.ButtonScanner(lambda btn: self.events.put(btn))
+        self.watcher = watcher.Watcher(self.library, lambda c,r: self.events.put(lambda: self._libraryUpdated(c, r)))
+        self.tags = tags.TagReader(self.library, '/home/pi/.tags', lambda t: self.events.put(lambda: self._tagsRead(t)))
+        self.durations = durations.Durations(self.library, lambda s: self.playback.media(s), '/home/pi/.durations',
+            lambda s: self.events.put(lambda: self._durationRead(s)))
 
-    def bluetoothEvent(self, dev, op): self.menu().onBluetoothEvent(dev, op)
+    def bluetoothEvent(self, dev, op): self.events.put(lambda: self.menu().onBluetoothEvent(dev, op)) # on the UI thread
     def cleanup(self):
+        if self._indexTimer is not None: self._saveIndex()
+        self.metrics.stop()
+        self.tags.stop()
+        self.durations.stop()
+        self.watcher.stop()
         self.buttons.stop()
         self.scanner.stop()
         self.display.cleanup()
@@ -677,7 +763,6 @@ class UI:
     def clear(self): self.display.clear(_Background)
 
     def exit(self):
-        signal.alarm(0) # cancel any pending alarm to prevent an error being printed if an alarm happens during shutdown
         if self.sleeping: self.enableWifi(self.isWifiEnabled) # restore networking
         self.cleanup()
         sys.exit(0)
@@ -685,9 +770,23 @@ class UI:
     def menu(self): return self.stack[-1]
 
     def onPress(self, btn):
-        self.idleTicks = 0
         if self.sleeping: self.wake()
         else: self.menu().onPress(btn)
+        self._resetIdle()
+
+    def cachedMenu(self, cls, songs, *args, **kwargs): # returns a menu like one we built recently, if it's not in use
+        key = (cls, id(songs)) + args + tuple(sorted(kwargs.items()))
+        menu = self.menus.get(key)
+        if menu is None or menu.songs is not songs or menu in self.stack:
+            menu = cls(songs, *args, **kwargs)
+            self.menus.put(key, menu)
+        return menu
+
+    def requestPaint(self, menu):
+        if self._paint is None: menu.render() # we're not handling events, so paint right away
+        else:
+            if self._paint: self.stats['paintsMerged'] += 1
+            self._paint = True
 
     def push(self, menu):
         self.menu().leave()
@@ -703,28 +802,14 @@ class UI:
             while len(self.stack) > 1: self.stack.pop().deinit()
             self.menu().enter(False)
 
-    def getMedia(self, song):
-        return self.player.get_instance().media_new('file://' + urllib.parse.quote(self.library.getPath(song)))
-
-    def ensureMedia(self, song=None, parse=True):
-        media = None
-        if song is None: song = self.playlist.getCurrent()
-        if song:
-            media = self.player.get_media()
-            if not media:
-                media = self.getMedia(song)
-                if media: self.player.set_media(media)
-            if parse and media: media.parse()
-        return media
+    @property
+    def player(self): return self.playback.current # the vlc.MediaPlayer playing the current song
 
     def addSongs(self, songs, moveTo=False, trimNumbers=False):
-        if type(songs) != library.Song:
-            if self.shuffle:
-                songs = list(songs)
-                random.shuffle(songs)
-            else:
-                songs = list(sorted(songs, key=lambda s: s.artist.casefold() + "\n" + (s.title if not trimNumbers else _numRe.sub('', s.title)).casefold()))
+        if type(songs) != library.Song: # shuffling is done by the playlist's play order, so always add them in order
+            songs = list(sorted(songs, key=lambda s: s.artist.casefold() + "\n" + (s.title if not trimNumbers else _numRe.sub('', s.title)).casefold()))
         wasEmpty = self.playlist.isempty()
+        if moveTo and self.shuffle and type(songs) != library.Song and songs: moveTo = random.choice(songs) # start anywhere
         first = self.playlist.add(songs, moveTo)
         if first:
             self.playlist.save()
@@ -751,18 +836,18 @@ class UI:
         else: self.stopPlaying()
 
     def playSong(self, song, toggle=False):
-        url = 'file://' + urllib.parse.quote(self.library.getPath(song))
+        url = self.playback.mrl(song)
         currentMedia = self.player.get_media()
         if currentMedia is None or currentMedia.get_mrl() != url:
-            media = self.player.get_instance().media_new(url)
-            self.player.set_media(media)
+            if self.playback.nextSong is not song or not self.playback.switch(): self.playback.load(song)
             self._play()
+            self._prepareNext()
         else:
             if not self.player.is_playing():
-                # restart if we're at the end. vlc doesn't set position to 1 at the end, so it may be 0.998 or something
-                tte = (1 - self.player.get_position()) * currentMedia.get_duration() # see how long that is in milliseconds
-                # set_position doesn't work if the song is not playing, but it won't play if we're already at the end...
-                if tte < 1000: self.player.stop() # so restart it by calling .stop()
+                # restart if we're at the end. vlc doesn't report the time as the length at the end, so it may be a bit less
+                pos = self.playback.position(song)
+                # set_time doesn't work if the song is not playing, but it won't play if we're already at the end...
+                if pos and pos[1] - pos[0] < 1000: self.playback.stop() # so restart it by calling .stop()
                 self._play()
             elif toggle:
                 self.pausePlaying()
@@ -772,9 +857,10 @@ class UI:
         self.playSong(self.addSongs(songs, moveTo=True, trimNumbers=trimNumbers), toggle)
 
     def pausePlaying(self):
-        self.player.pause()
+        self.playback.pause()
         self.shouldBePlaying = False
         self.pendingPlay = 0
+        self._resetIdle()
 
     def previousTrack(self, canRewind=False): return self._prevNextTrack(buttons.KEY_PREVIOUS, canRewind)
     def nextTrack(self): return self._prevNextTrack(buttons.KEY_NEXT)
@@ -787,31 +873,37 @@ class UI:
     def setVolume(self, volume):
         volume = max(0, min(100, volume))
         if volume != self.volume:
-            self.player.audio_set_volume(volume)
+            self.playback.setVolume(volume)
             self.volume = volume
 
-    def shuffleSongs(self, changeSong=False):
-        self.playlist.shuffle(changeSong)
-        if not changeSong and not self.playlist.isempty(): self.saveSettings()
+    def shuffleSongs(self, changeSong=False): # turns shuffling on or off to match self.shuffle
+        self.playlist.setShuffle(self.shuffle)
+        if changeSong and self.shuffle and not self.playlist.isempty(): self.playlist.select(self.playlist.next())
+        self.saveSettings()
 
     def sleep(self, disableWifi=False):
         self.sleeping = True
-        signal.alarm(0) # cancel pending alarms
+        self._resetIdle() # there's no timer while we're asleep, so we sleep until an event arrives
         self.pausePlaying()
+        self.menu().leave() # stop its timers until we wake
+        self.metrics.stop()
         if disableWifi: subprocess.run(['/usr/bin/sudo', '/usr/local/bin/kill-wifi'])
         subprocess.run(['/usr/sbin/rfkill', 'block', 'bluetooth'])
         self.display.power(False)
 
     def wake(self):
         self.sleeping = False
-        signal.alarm(1) # resume alarms
+        self._resetIdle()
         self.enableWifi(self.isWifiEnabled)
         self.display.power(True)
+        self.metrics.start()
+        self.menu().enter(False)
 
     def stopPlaying(self):
-        self.player.stop()
+        self.playback.stop()
         self.shouldBePlaying = False
         self.pendingPlay = 0
+        self._resetIdle()
 
     def togglePlay(self):
         if not self.player.is_playing(): self._play()
@@ -825,11 +917,6 @@ class UI:
 
     def run(self):
         def shutdown(sig, frame): self.exit()
-        def onalarm(sig, frame):
-            if not self.sleeping:
-                self.events.put(0)
-                signal.alarm(1)
-        signal.signal(signal.SIGALRM, onalarm)
         signal.signal(signal.SIGHUP, shutdown)
         signal.signal(signal.SIGINT, shutdown)
         signal.signal(signal.SIGTERM, shutdown)
@@ -837,12 +924,12 @@ class UI:
         signal.signal(signal.SIGUSR1, lambda s,f: self.events.put(buttons.KEY_PREVIOUS))
         signal.signal(signal.SIGUSR2, lambda s,f: self.events.put(buttons.KEY_NEXT))
         self.scanner.start()
-        self.library.scan()
-        self.playlist = library.Playlist('/home/pi/music/playlist', self.library)
-        self.player = vlc.MediaPlayer()
-        self.buttons.start()
-        self.idleTicks = 0
+        self.metrics.start()
+        self.playback = playback.Engine(self.library, self.events.put) # vlc's events are handled on our thread
+        self._endTimer = None
+        self._errors = 0 # songs that failed to play in a row
         self.volume = 100
+        self._resume = self._shuffleState = None
 
         try:
             with open('/home/pi/.player') as f:
@@ -850,38 +937,140 @@ class UI:
                 self.repeat = settings.get('repeat', self.repeat)
                 self.shuffle = settings.get('shuffle', self.shuffle)
                 self.volume = max(0, min(100, settings.get('volume', 100)))
-                song = settings.get('song')
-                if song: self.playlist.select(song)
+                self._resume = settings.get('song')
+                self._shuffleState = settings.get('shuffleState')
         except: pass
 
-        self.player.audio_set_volume(self.volume)
+        # load the library in the background, starting with the group containing the song to resume. we'll leave the
+        # loading screen as soon as that song is known rather than waiting for the whole library
+        self.playlist = library.Playlist('/home/pi/music/playlist', self.library, loading=True)
+        self.loading = self.scanning = True
+        threading.Thread(target=self._loadLibrary, name='LibraryLoader', daemon=True).start()
+        self.buttons.start()
+        self.playback.setVolume(self.volume)
         self.pendingPlay = 0
         self.shouldBePlaying = False
         self.isWifiEnabled = self._checkWifiEnabled()
-        self.stack.pop().leave()
-        self.stack.append(RootMenu())
-        self.menu().init(self)
-        signal.alarm(1)
-        while True: # TODO: now that we have a queue, collapse painting together, etc
-            e = self.events.get()
-            if e == 0: self.tick()
-            elif e <= 40: self.onPress(e)
-            else: self._mediaButton(e)
+        self._resetIdle()
+        while True:
+            batch = []
+            try: # wait until an event arrives or a timer is due, then take whatever else is waiting so we paint once
+                batch.append(self.events.get(timeout=self.timers.timeout()))
+                while len(batch) < 32: batch.append(self.events.get_nowait())
+            except queue.Empty: pass
+            self._handleEvents(batch)
 
     def saveSettings(self):
         settings = {'repeat':self.repeat, 'shuffle':self.shuffle, 'volume':self.volume}
         song = self.playlist.getCurrent()
         if song: settings['song'] = song.path
-        with open('/home/pi/.player', 'w') as f: f.write(json.dumps(settings))
-
-    def tick(self):
-        self.menu().tick()
-        if self.pendingPlay and time.monotonic() >= self.pendingPlay:
-            self.playCurrent()
-            self._repaint(RootMenu)
-        elif not self.shouldBePlaying and not self.pendingPlay:
-            self.idleTicks += 1
-            if self.idleTicks == 180: self.sleep() # go to sleep after 3 minutes of idleness
+        if self.playlist.shuffled: settings['shuffleState'] = self.playlist.shuffled.state()
+        with open('/home/pi/.player.tmp', 'w') as f:
+            f.write(json.dumps(settings))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace('/home/pi/.player.tmp', '/home/pi/.player') # so a power cut can't leave half a settings file
+
+    def _addGroup(self, group):
+        self.library.addGroup(group)
+        self.playlist.bind()
+        if self._resume and self.playlist.select(self._resume):
+            self._resume = None
+            if self.loading: self._showRoot()
+        if not self.loading:
+            for menu in self.stack: menu.onLibraryChanged()
+
+    def _durationRead(self, song):
+        if song is self.playlist.getCurrent(): self._repaint(RootMenu)
+
+    def _handleEvents(self, batch): # handle events in order, then any timers that are due, and paint no more than once
+        self._paint = False
+        for e in batch:
+            if callable(e): e() # a function marshalled onto this thread
+            elif isinstance(e, playback.Event): self._playerEvent(e)
+            elif e <= 40: self.onPress(e)
+            else: self._mediaButton(e)
+        self.timers.run()
+        if self._paint:
+            self.menu().render()
+            self.stats['paints'] += 1
+        self._paint = None
+        self.stats['events'] += len(batch)
+        self.stats['batches'] += 1
+
+    def _libraryLoaded(self):
+        self.scanning = False
+        self.playlist.bind(final=True)
+        if self._resume: self.playlist.select(self._resume)
+        if self.shuffle: self.playlist.setShuffle(True, self._shuffleState) # continue the same random order
+        self._resume = self._shuffleState = None
+        if self.loading: self._showRoot()
+        else:
+            for menu in self.stack: menu.onLibraryChanged() # menus under the top one may be showing stale lists too
+        self.watcher.start() # pick up music that's added or removed from now on without rescanning everything
+        self.tags.read(self.library.untagged()) # and improve artists and titles of songs whose tags we haven't read
+
+    def _libraryUpdated(self, changes, renames):
+        change = self.library.update(changes, renames)
+        self._saveIndexSoon() # so new songs keep their IDs after a restart
+        if change is None: return
+        for (old, new) in change.renamed:
+            if self.playlist.replace(old, new): change.playlistChanged = True
+        gone = [s for s in change.removed if self.playlist.contains(s)]
+        if gone:
+            self.removeSongs(gone)
+            change.playlistChanged = True
+        elif change.playlistChanged: self.playlist.save()
+        self.tags.read(self.library.untagged({g.name for g in change.groups}))
+        self.menus.clear() # rather than keep menus we're not showing up to date
+        for menu in self.stack: menu.onLibraryChanged(change)
+
+    def _tagsRead(self, tags):
+        change = self.library.applyTags(tags)
+        self._saveIndexSoon() # it has the names from the tags now
+        if change is not None:
+            change.playlistChanged = any(self.playlist.contains(s) for s in change.retagged)
+            self.menus.clear()
+            for menu in self.stack: menu.onLibraryChanged(change)
+
+    def _loadLibrary(self):
+        lastPaint = 0
+        def onProgress(dirs, songs):
+            nonlocal lastPaint
+            self.loadProgress = (dirs, songs)
+            now = time.monotonic()
+            if now - lastPaint >= 0.25: # don't flood the queue with a repaint for every directory
+                lastPaint = now
+                self.events.put(lambda: self._repaint(LoadingMenu))
+        try:
+            self.library.scan(onGroup=lambda g: self.events.put(lambda: self._addGroup(g)), onProgress=onProgress,
+                first=self._resume.split('/', 1)[0] if self._resume else None)
+        finally:
+            self.events.put(self._libraryLoaded)
+
+    def _saveIndex(self):
+        if self._indexTimer is not None: self._indexTimer.cancel()
+        self._indexTimer = None
+        self.library.saveIndex()
+
+    def _saveIndexSoon(self): # changes tend to come in bursts, so write the index once they've stopped for a while
+        if self._indexTimer is not None: self._indexTimer.cancel()
+        self._indexTimer = self.timers.after(10, self._saveIndex)
+
+    def _idle(self): # go to sleep after 3 minutes of idleness. if we're busy, the timer is set again once we stop
+        self._idleTimer = None
+        if not self.shouldBePlaying and not self.pendingPlay and not self.loading: self.sleep()
+
+    def _resetIdle(self):
+        if self._idleTimer is not None: self._idleTimer.cancel()
+        self._idleTimer = self.timers.after(180, self._idle) if not self.sleeping else None
+
+    def _showRoot(self):
+        self.loading = False
+        self._resetIdle()
+        self.stack.pop().leave()
+        self.stack.append(RootMenu())
+        self.menu().init(self)
 
     def _checkWifiEnabled(self):
         p = subprocess.run(['/usr/sbin/rfkill', '--json'], capture_output=True)
@@ -892,7 +1081,6 @@ class UI:
         return False
 
     def _mediaButton(self, btn):
-        self.idleTicks = 0
         if self.sleeping: self.wake()
         if btn == buttons.KEY_PREVIOUS or btn == buttons.KEY_NEXT: self._prevNextTrack(btn, True)
         elif btn == buttons.KEY_PLAY: self.playCurrent()
@@ -901,9 +1089,45 @@ class UI:
         elif btn == buttons.KEY_PLAYPAUSE:
             if self.player.is_playing(): self.pausePlaying()
             else: self.playCurrent()
+        self._resetIdle()
+
+    def _playerEvent(self, e):
+        if not self.playback.handle(e): return # it's about the song waiting to play next
+        if e.kind == playback.Event.EndReached or e.kind == playback.Event.Error:
+            if e.kind == playback.Event.Error: self._errors += 1
+            if self.pendingPlay or not self.shouldBePlaying: return
+            newIndex = self.playlist.next(wrap=self.repeat)
+            # move on to the next song, unless every song has failed to play
+            if newIndex is not None and self._errors < len(self.playlist.songs) and self.selectSong(newIndex) >= 0:
+                self.playCurrent()
+            else: self.stopPlaying()
+            self._repaint(RootMenu)
+        else:
+            if e.kind == playback.Event.TimeChanged and e.value > 0: self._errors = 0
+            if self.shouldBePlaying and not self.pendingPlay: self._prepareNext()
+            self.menu().onPlayerEvent(e)
+
+    def _prepareNext(self): # keep the song after this one loaded, and switch to it on time if this one is nearly done
+        index = self.playlist.next(wrap=self.repeat)
+        self.playback.preload(self.playlist.songs[index] if index is not None else None)
+        remaining = self.playback.remaining()
+        if self._endTimer is None and remaining is not None and remaining < 3000:
+            self._endTimer = self.timers.after(max(0, remaining/1000 - _Lead), self._songEnding)
+
+    def _songEnding(self):
+        self._endTimer = None
+        remaining = self.playback.remaining()
+        if not self.shouldBePlaying or self.pendingPlay or remaining is None: return
+        if remaining > _Lead*2000: return self._prepareNext() # it was paused or they seeked, so reschedule
+        index = self.playlist.next(wrap=self.repeat)
+        if index is None or self.playlist.songs[index] is not self.playback.nextSong or not self.playback.switch():
+            return # the end will be handled when vlc reports it
+        self.selectSong(index)
+        self._prepareNext()
+        self._repaint(RootMenu)
 
     def _play(self):
-        self.player.play()
+        self.playback.play()
         self.shouldBePlaying = True
         self.pendingPlay = 0
 
@@ -911,22 +1135,27 @@ class UI:
         changed = False
         rewind = False
         if canRewind and btn == buttons.KEY_PREVIOUS and not self.pendingPlay and self.shouldBePlaying:
-            media = self.ensureMedia()
-            rewind = media and media.get_duration() * self.player.get_position() > 5000
+            pos = self.playback.position(self.playlist.getCurrent())
+            rewind = pos is not None and pos[0] > 5000
         if rewind:
-            self.player.set_position(0)
+            self.playback.seek(0)
             changed = True
         else:
             oldIndex = self.playlist.index
-            newIndex = oldIndex + (-1 if btn == buttons.KEY_PREVIOUS else 1)
-            if newIndex < 0: newIndex = self.playlist.count() - 1
-            elif newIndex >= self.playlist.count(): newIndex = 0
-            if self.selectSong(newIndex) != oldIndex:
+            newIndex = self.playlist.next(-1 if btn == buttons.KEY_PREVIOUS else 1, wrap=True)
+            if newIndex is not None and self.selectSong(newIndex) != oldIndex:
                 changed = True
-                if self.shouldBePlaying: self.pendingPlay = time.monotonic() + 1.5
+                if self.shouldBePlaying: # wait a moment in case they're skipping through several tracks
+                    self.pendingPlay = time.monotonic() + 1.5
+                    self.timers.after(1.5, self._playPending)
 
         if changed: self._repaint(RootMenu)
 
+    def _playPending(self):
+        if self.pendingPlay and time.monotonic() >= self.pendingPlay: # it wasn't cancelled or pushed back since
+            self.playCurrent()
+            self._repaint(RootMenu)
+
     def _repaint(self, menuType): # yuck?
          if isinstance(self.menu(), menuType): self.menu().paint()
 
@@ -0,0 +1,65 @@
+import cache
+import os
+
+try:
+    import mutagen
+except ImportError: # without mutagen we just keep the artists and titles parsed from the file names
+    mutagen = None
+
+_cacheVersion = 1
+_chunkSize = 100
+
+# reads artists and titles from the songs' embedded tags (ID3, Vorbis comments, MP4 atoms, etc.), caching them in a
+# cache.FileCache. onTags(results) is called on a worker thread with a list of (song, artist, title), where artist and
+# title are None if the tags don't have them, once for all the songs that were cached and then for every 100 songs or so
+# read
+class TagReader:
+    def __init__(self, library, cacheFile, onTags, workers=2):
+        self.library = library
+        self.onTags = onTags
+        self._cache = cache.FileCache(cacheFile, library.keepCached, _cacheVersion, 'TagReader', workers)
+
+    def read(self, songs): # queue songs to have their tags read
+        if mutagen is None: return
+        songs = list(songs)
+        if songs: self._cache.submit(self._lookup, songs)
+
+    def stop(self): self._cache.stop()
+
+    def _lookup(self, songs): # report the songs that are cached in one batch, and queue the rest to be read
+        (results, unknown) = ([], [])
+        for song in songs:
+            if self._cache.quitting: return
+            try: s = os.stat(self.library.getPath(song))
+            except OSError: continue
+            tags = self._cache.get(song.path, s)
+            if tags is None: unknown.append(song)
+            else: results.append((song, tags[0], tags[1]))
+        if results: self.onTags(results)
+        for i in range(0, len(unknown), _chunkSize): self._cache.submit(self._readChunk, unknown[i:i+_chunkSize])
+
+    def _readChunk(self, songs):
+        results = []
+        for song in songs:
+            if self._cache.quitting: return
+            path = self.library.getPath(song)
+            try: s = os.stat(path)
+            except OSError: continue
+            tags = self._cache.get(song.path, s)
+            if tags is None:
+                tags = _readTags(path)
+                self._cache.put(song.path, s, tags)
+            results.append((song, tags[0], tags[1]))
+        if results: self.onTags(results)
+
+def _readTags(path): # returns [artist, title], either of which may be None
+    try:
+        f = mutagen.File(path, easy=True)
+        tags = f.tags if f is not None else None
+    except Exception: tags = None # mutagen raises all sorts of things for files it doesn't like
+    def get(key):
+        try: values = tags.get(key) if tags else None
+        except (KeyError, ValueError): values = None
+        value = values[0].strip() if values else ''
+        return value or None
+    return [get('artist'), get('title')]
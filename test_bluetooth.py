@@ -0,0 +1,175 @@
+import bluetooth
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import time
+import unittest
+
+_Dev1 = '/org/bluez/hci0/dev_AA_BB_CC_DD_EE_01'
+_Dev2 = '/org/bluez/hci0/dev_AA_BB_CC_DD_EE_02'
+
+# tests DBusScanner against a fake BlueZ running in another process on a private session bus. run it with
+# python3 -m unittest test_bluetooth
+@unittest.skipIf(bluetooth.dbus is None or not shutil.which('dbus-daemon'), 'needs dbus-python, PyGObject and dbus-daemon')
+class DBusScannerTest(unittest.TestCase):
+    def setUp(self):
+        self.daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'], stdout=subprocess.PIPE,
+            text=True)
+        self.address = self.daemon.stdout.readline().strip()
+        self.fake = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--fake-bluez', self.address])
+        self.bus = bluetooth.dbus.bus.BusConnection(self.address)
+        self._wait(lambda: self.bus.name_has_owner('org.bluez'))
+        self.test = bluetooth.dbus.Interface(self.bus.get_object('org.bluez', '/'), 'org.bluez.Test')
+        self.events = queue.Queue()
+        self.scanner = bluetooth.DBusScanner(onAdded=lambda s,d: self.events.put(('A', d.addr)),
+            onChanged=lambda s,d: self.events.put(('C', d.addr)), onRemoved=lambda s,d: self.events.put(('R', d.addr)),
+            bus=self.address)
+
+    def tearDown(self):
+        self.scanner.stop()
+        self.bus.close()
+        for p in (self.fake, self.daemon):
+            p.terminate()
+            p.wait()
+        self.daemon.stdout.close()
+
+    def testDevices(self):
+        self.scanner.start()
+        self._expect('A', 'AA:BB:CC:DD:EE:01')
+        dev = self.scanner.devices['AA:BB:CC:DD:EE:01']
+        self.assertEqual((dev.name, dev.cls, dev.uuids), ('Speaker', 0x240414, [bluetooth.AUDIO_SINK]))
+        self.assertEqual((dev.paired, dev.trusted, dev.connected, dev.rssi), (False, False, False, -60))
+        self.test.AddDevice(_Dev2, {'Address': 'AA:BB:CC:DD:EE:02', 'Name': 'Phone'})
+        self._expect('A', 'AA:BB:CC:DD:EE:02')
+        self.assertEqual(self.scanner.devices['AA:BB:CC:DD:EE:02'].name, 'Phone')
+        for rssi in (-40, -20):
+            self.test.SetProperty(_Dev1, 'RSSI', bluetooth.dbus.Int16(rssi))
+            self._expect('C', 'AA:BB:CC:DD:EE:01')
+        self.assertEqual(dev.rssis, [-60, -40, -20]) # averaged
+        self.assertEqual(dev.rssi, -40)
+        self.test.SetProperty(_Dev1, 'Connected', True)
+        self._expect('C', 'AA:BB:CC:DD:EE:01')
+        self.assertTrue(dev.connected)
+        self.test.DropDevice(_Dev1)
+        self._expect('R', 'AA:BB:CC:DD:EE:01')
+        self.assertNotIn('AA:BB:CC:DD:EE:01', self.scanner.devices)
+
+    def testCalls(self):
+        self.scanner.start(startScan=True)
+        self._expect('A', 'AA:BB:CC:DD:EE:01')
+        self._expectCalls('/org/bluez RegisterAgent /player/agent NoInputNoOutput', '/org/bluez/hci0 StartDiscovery',
+            '/org/bluez/hci0 Set org.bluez.Adapter1 Discoverable True', '/org/bluez/hci0 Set org.bluez.Adapter1 Pairable True')
+        dev = self.scanner.devices['AA:BB:CC:DD:EE:01']
+        self.scanner.connect(dev)
+        self.scanner.pair('AA:BB:CC:DD:EE:01')
+        self.scanner.trust(dev)
+        self.scanner.connect('AA:BB:CC:DD:EE:99') # unknown, so nothing should be sent to the adapter or anything else
+        self.scanner.disconnect(dev)
+        self._expectCalls(_Dev1 + ' Connect', _Dev1 + ' Pair', _Dev1 + ' Set org.bluez.Device1 Trusted True',
+            _Dev1 + ' Disconnect')
+        self.assertFalse([c for c in self.test.Calls() if c.startswith('/org/bluez/hci0 Connect')])
+        self.scanner.remove(dev)
+        self._expectCalls('/org/bluez/hci0 RemoveDevice ' + _Dev1)
+        self.assertNotIn('AA:BB:CC:DD:EE:01', self.scanner.devices)
+        self.scanner.stop()
+        self._expectCalls('/org/bluez/hci0 StopDiscovery', '/org/bluez UnregisterAgent /player/agent')
+
+    def _expect(self, op, addr): # wait for a callback, skipping others
+        deadline = time.monotonic() + 5
+        while True:
+            e = self.events.get(timeout=max(0, deadline - time.monotonic()))
+            if e == (op, addr): return
+
+    def _expectCalls(self, *calls):
+        self._wait(lambda: not set(calls) - set(self.test.Calls()), 'calls {} not in {}'.format(calls, self.test.Calls()))
+
+    def _wait(self, fn, message=None):
+        deadline = time.monotonic() + 5
+        while not fn():
+            if time.monotonic() > deadline: self.fail(message or 'timed out')
+            time.sleep(0.02)
+
+def _fakeBluez(address): # serves just enough of BlueZ for the tests, plus org.bluez.Test to control it
+    import dbus.mainloop.glib, dbus.service
+    from gi.repository import GLib
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    calls = []
+    objects = {}
+
+    class Object(dbus.service.Object):
+        def __init__(self, path, ifaces):
+            super().__init__(bus, path)
+            (self.path, self.ifaces) = (path, ifaces)
+            objects[path] = self
+        def call(self, method, *args): calls.append(' '.join([self.path, method] + [str(a) for a in args]))
+
+        @dbus.service.method('org.freedesktop.DBus.Properties', in_signature='ssv')
+        def Set(self, iface, name, value):
+            self.call('Set', iface, name, bool(value) if isinstance(value, dbus.Boolean) else value)
+        @dbus.service.signal('org.freedesktop.DBus.Properties', signature='sa{sv}as')
+        def PropertiesChanged(self, iface, changed, invalidated): pass
+
+        @dbus.service.method('org.bluez.Adapter1')
+        def StartDiscovery(self): self.call('StartDiscovery')
+        @dbus.service.method('org.bluez.Adapter1')
+        def StopDiscovery(self): self.call('StopDiscovery')
+        @dbus.service.method('org.bluez.Adapter1', in_signature='o')
+        def RemoveDevice(self, path):
+            self.call('RemoveDevice', path)
+            root.drop(path)
+
+        @dbus.service.method('org.bluez.Device1')
+        def Connect(self): self.call('Connect')
+        @dbus.service.method('org.bluez.Device1')
+        def Disconnect(self): self.call('Disconnect')
+        @dbus.service.method('org.bluez.Device1')
+        def Pair(self): self.call('Pair')
+
+        @dbus.service.method('org.bluez.AgentManager1', in_signature='os')
+        def RegisterAgent(self, path, capability): self.call('RegisterAgent', path, capability)
+        @dbus.service.method('org.bluez.AgentManager1', in_signature='o')
+        def RequestDefaultAgent(self, path): self.call('RequestDefaultAgent', path)
+        @dbus.service.method('org.bluez.AgentManager1', in_signature='o')
+        def UnregisterAgent(self, path): self.call('UnregisterAgent', path)
+
+    class Root(Object):
+        def drop(self, path):
+            o = objects.pop(path)
+            o.remove_from_connection()
+            self.InterfacesRemoved(path, list(o.ifaces))
+
+        @dbus.service.method('org.freedesktop.DBus.ObjectManager', out_signature='a{oa{sa{sv}}}')
+        def GetManagedObjects(self): return {p: o.ifaces for p, o in objects.items() if o.ifaces}
+        @dbus.service.signal('org.freedesktop.DBus.ObjectManager', signature='oa{sa{sv}}')
+        def InterfacesAdded(self, path, ifaces): pass
+        @dbus.service.signal('org.freedesktop.DBus.ObjectManager', signature='oas')
+        def InterfacesRemoved(self, path, ifaces): pass
+
+        @dbus.service.method('org.bluez.Test', in_signature='oa{sv}')
+        def AddDevice(self, path, props):
+            Object(path, {'org.bluez.Device1': props})
+            self.InterfacesAdded(path, objects[path].ifaces)
+        @dbus.service.method('org.bluez.Test', out_signature='as')
+        def Calls(self): return calls
+        @dbus.service.method('org.bluez.Test', in_signature='o')
+        def DropDevice(self, path): self.drop(path)
+        @dbus.service.method('org.bluez.Test', in_signature='osv')
+        def SetProperty(self, path, name, value):
+            objects[path].ifaces['org.bluez.Device1'][name] = value
+            objects[path].PropertiesChanged('org.bluez.Device1', {name: value}, [])
+
+    root = Root('/', {})
+    Object('/org/bluez', {})
+    Object('/org/bluez/hci0', {'org.bluez.Adapter1': {'Address': '00:11:22:33:44:55'}})
+    Object(_Dev1, {'org.bluez.Device1': {'Address': 'AA:BB:CC:DD:EE:01', 'Name': 'Speaker', 'Class': dbus.UInt32(0x240414),
+        'UUIDs': dbus.Array([bluetooth.AUDIO_SINK], 's'), 'Paired': False, 'Trusted': False, 'Connected': False,
+        'RSSI': dbus.Int16(-60)}})
+    name = dbus.service.BusName('org.bluez', bus)
+    GLib.MainLoop().run()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--fake-bluez']: _fakeBluez(sys.argv[2])
+    else: unittest.main()
@@ -0,0 +1,59 @@
+import json
+import library
+import random
+import unittest
+
+# python3 -m unittest test_library
+class ShuffleTest(unittest.TestCase):
+    def setUp(self):
+        self.playlist = library.Playlist(None, None)
+        self.songs = [library.Song('Music/{}.mp3'.format(i), 'Artist', 'Title ' + str(i), i) for i in range(1, 41)]
+        self.playlist.add(self.songs[:28])
+        self.playlist.setShuffle(True)
+
+    def testAddedSongsPlayOncePerPass(self):
+        for seed in range(20):
+            self.setUp()
+            album = self.songs[28:]
+            current = self.playlist.getCurrent()
+            start = random.Random(seed).choice(album)
+            self.assertIs(self.playlist.add(album, start), start)
+            self.assertIs(self.playlist.getCurrent(), start)
+            self.assertIs(self.playlist.songs[self.playlist.next(-1)], current) # not an album song we never heard
+            played = [current, start]
+            while True:
+                index = self.playlist.next()
+                if index is None: break
+                self.playlist.select(index)
+                played.append(self.playlist.getCurrent())
+            self.assertEqual(sorted(s.id for s in played), [s.id for s in self.songs])
+
+    def testAddMovesToFirstSong(self):
+        album = self.songs[28:]
+        self.assertIs(self.playlist.add(album, True), album[0])
+        self.assertIs(self.playlist.getCurrent(), album[0])
+        self.assertEqual(self.playlist.shuffled.history, [self.songs[0], album[0]])
+
+    def testStateRoundTrip(self):
+        for i in range(5): self.playlist.select(self.playlist.next())
+        shuffled = self.playlist.shuffled
+        state = json.loads(json.dumps(shuffled.state()))
+        restored = library.Shuffle(self.playlist.songs)
+        restored.restore(state)
+        self.assertEqual(restored.history, shuffled.history)
+        self.assertEqual(restored.cursor, shuffled.cursor)
+        self.assertEqual(restored._played, shuffled._played)
+
+    def testStateLimitsPlayedRanges(self):
+        for i in range(5): self.playlist.select(self.playlist.next())
+        self.playlist.shuffled._played.update((10, 20)) # so they can't fit in one range
+        (limit, library._playedLimit) = (library._playedLimit, 1)
+        try: state = self.playlist.shuffled.state()
+        finally: library._playedLimit = limit
+        self.assertNotIn('played', state)
+        restored = library.Shuffle(self.playlist.songs)
+        restored.restore(state)
+        self.assertEqual(restored.history, self.playlist.shuffled.history)
+
+if __name__ == '__main__':
+    unittest.main()
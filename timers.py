@@ -0,0 +1,48 @@
+import heapq
+import itertools
+import time
+
+class Timer:
+    def __init__(self, deadline, interval, callback):
+        self.deadline = deadline # in terms of the scheduler's clock
+        self.interval = interval # None for a one-shot timer
+        self.callback = callback
+        self.active = True
+
+    def cancel(self): self.active = False
+
+# one-shot and periodic timers on a monotonic clock, kept in a heap ordered by deadline. the owner of the event loop
+# sleeps for timeout() and then calls run(), so nothing wakes up unless a timer is due. it's not thread-safe, so other
+# threads should marshal their calls onto the loop's thread
+class Scheduler:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count() # keeps timers with the same deadline in the order they were added
+
+    def after(self, delay, callback): return self._add(Timer(self.clock() + delay, None, callback)) # calls callback()
+
+    def every(self, interval, callback, delay=None): # calls callback(count) with how many intervals have passed
+        return self._add(Timer(self.clock() + (interval if delay is None else delay), interval, callback))
+
+    def run(self): # runs the timers that are due
+        now = self.clock()
+        while self._heap and self._heap[0][0] <= now:
+            timer = heapq.heappop(self._heap)[2]
+            if not timer.active: continue
+            if timer.interval is None:
+                timer.active = False
+                timer.callback()
+            else: # if we're late, skip the missed deadlines and tell the callback how many there were
+                count = int((now - timer.deadline) // timer.interval) + 1
+                timer.deadline += count * timer.interval
+                self._add(timer) # before calling it, so the callback can cancel it
+                timer.callback(count)
+
+    def timeout(self): # returns the seconds until the next timer is due, or None if there are no timers
+        while self._heap and not self._heap[0][2].active: heapq.heappop(self._heap)
+        return max(0, self._heap[0][0] - self.clock()) if self._heap else None
+
+    def _add(self, timer):
+        heapq.heappush(self._heap, (timer.deadline, next(self._seq), timer))
+        return timer
@@ -0,0 +1,128 @@
+import ctypes
+import os
+import select
+import struct
+import threading
+import time
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+
+_Mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_Header = struct.Struct('iIII') # struct inotify_event: wd, mask, cookie, len, followed by the name
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+# watches the library's directories with inotify. events are collected until the tree has been quiet for 'delay' seconds
+# (or 'maxDelay' seconds have passed) so an rsync produces one batch, then the changed directories are re-read on the
+# watcher's thread and onChange(changes, renames) is called there. 'changes' maps a directory's relative path ('' for the
+# root) to its new (mtime, entries), or None if it's gone, and 'renames' maps old relative paths to new ones
+class Watcher:
+    def __init__(self, library, onChange, delay=2, maxDelay=10):
+        self.library = library
+        self.onChange = onChange
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self._fd = None
+
+    def start(self):
+        self._fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        (self._rels, self._wds) = ({}, {}) # wd -> rel and rel -> wd
+        self._quitEvent = threading.Event()
+        self._thread = threading.Thread(target=self._main, args=([''] + self.library.dirs(),), name='LibraryWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._fd is not None:
+            self._quitEvent.set()
+            self._thread.join()
+            os.close(self._fd)
+            self._fd = None
+
+    def _main(self, rels):
+        for rel in rels: self._watch(rel)
+        (pending, moves, renames, first, last) = ({}, {}, {}, None, None)
+        while not self._quitEvent.is_set():
+            now = time.monotonic()
+            if first is not None and (now - last >= self.delay or now - first >= self.maxDelay):
+                self._flush(pending, renames)
+                (pending, moves, renames, first) = ({}, {}, {}, None)
+                continue
+            timeout = 1 if first is None else max(0, min(1, last + self.delay - now))
+            if not select.select([self._fd], [], [], timeout)[0]: continue
+            for (wd, mask, cookie, name) in self._read():
+                if mask & IN_Q_OVERFLOW: # we lost events, so re-read everything
+                    for rel in self._wds: pending[rel] = None
+                elif mask & IN_IGNORED: self._forget(wd)
+                else:
+                    rel = self._rels.get(wd)
+                    if rel is None: continue
+                    if mask & IN_MOVE_SELF: # the directory moved, so our path for it is stale. its new parent will see it
+                        self._unwatch(rel)
+                        continue
+                    if not mask & IN_DELETE_SELF: pending[rel] = None
+                    path = rel + '/' + name if rel else name
+                    if mask & IN_MOVED_FROM: moves[cookie] = path
+                    elif mask & IN_MOVED_TO and cookie in moves: renames[moves.pop(cookie)] = path
+                if first is None: first = time.monotonic()
+                last = time.monotonic()
+
+    def _flush(self, pending, renames):
+        changes = {}
+        for rel in pending:
+            if rel in self._wds or rel == '': changes[rel] = self.library.readDir(rel)
+        for rel, d in list(changes.items()): # forget subdirectories that are gone and pick up new ones
+            prefix = rel + '/' if rel else ''
+            subdirs = {prefix + e[0] for e in d[1] if len(e) == 1} if d else ()
+            for child in [r for r in self._wds if r.startswith(prefix) and r.count('/') == prefix.count('/') and r]:
+                if child not in subdirs: self._unwatch(child)
+            for child in subdirs:
+                if child not in self._wds: self._add(child, changes)
+        if changes: self.onChange(changes, renames)
+
+    def _add(self, rel, changes): # start watching a new directory before reading it, so we don't miss what lands next
+        if self._watch(rel):
+            changes[rel] = d = self.library.readDir(rel)
+            if d:
+                for e in d[1]:
+                    if len(e) == 1: self._add(rel + '/' + e[0], changes)
+
+    def _forget(self, wd):
+        rel = self._rels.pop(wd, None)
+        if rel is not None and self._wds.get(rel) == wd: del self._wds[rel]
+
+    def _read(self):
+        try: buf = os.read(self._fd, 64*1024)
+        except BlockingIOError: return
+        i = 0
+        while i < len(buf):
+            (wd, mask, cookie, length) = _Header.unpack_from(buf, i)
+            i += _Header.size
+            yield (wd, mask, cookie, buf[i:i+length].rstrip(b'\0').decode('utf-8', 'surrogateescape'))
+            i += length
+
+    def _unwatch(self, rel):
+        prefix = rel + '/'
+        for r in [r for r in self._wds if r == rel or r.startswith(prefix)]:
+            wd = self._wds.pop(r)
+            if self._rels.get(wd) == r:
+                del self._rels[wd]
+                _libc.inotify_rm_watch(self._fd, wd)
+
+    def _watch(self, rel):
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(os.path.join(self.library.root, rel)), _Mask)
+        if wd < 0: return False
+        old = self._rels.get(wd)
+        if old is not None and self._wds.get(old) == wd: del self._wds[old] # the inode was moved here from elsewhere
+        (self._rels[wd], self._wds[rel]) = (rel, wd)
+        return True